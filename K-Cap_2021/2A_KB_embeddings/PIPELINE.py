@@ -31,8 +31,9 @@ def main():
     # Iterate over urls to ocrs from urls/ and retrieve ocrs.
     #   each ocr record is stored on a newline and subtended by <ocr url=></ocr> tags
     #   paragraphs within a single ocr are separated by <par> uni-tags 
+    #   partial downloads (ocrs/*.txt.part) continue from their last checkpoint
     # ------
-    subprocess.run(["python3", "get_ocrs.py"])  # output ocrs/
+    subprocess.run(["python3", "get_ocrs.py", "--resume"])  # output ocrs/
 
     # ------
     # Iterate over retrieved ocrs in ocrs/ and return text-analysed versions.
@@ -1,50 +1,206 @@
 """
 Retrieve ocr files corresponding to the urls sampled in urls/
 store in ocrs/
+
+Run:
+    python3 get_ocrs.py [--resume]
 """
+import argparse
 import typing
-import concurrent.futures
 import re
-import requests
 import os
-import time
-import itertools
 import xmltodict
 from tqdm import tqdm
 
+import kb_client
+from harvest import gen_fetched
+from kb_client import get_response
+
+parser = argparse.ArgumentParser(
+    description="""Retrieve the ocr files of the urls in urls/*.txt, output to ocrs/*.txt
+
+    Each ocrs/<query>.txt is written to ocrs/<query>.txt.part, and only renamed
+    to ocrs/<query>.txt once complete. Progress is checkpointed in
+    ocrs/<query>.txt.manifest, a line per checkpoint of the size of the .part
+    file, and the offsets (url file line numbers) of the urls completed since
+    the previous checkpoint.
+
+    Example:
+
+        python3 get_ocrs.py
+
+            retrieve ocrs for every urls/*.txt without a complete ocrs/*.txt,
+            restarting any partial download from scratch.
+
+        python3 get_ocrs.py --resume
+
+            as above, but continue partial downloads from their last checkpoint.
+    """,
+    formatter_class=argparse.RawTextHelpFormatter,
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    default=False,
+    help="continue partial downloads from ocrs/*.txt.manifest",
+)
+
 
 def main():
 
+    args = parser.parse_args()
+
+    max_in_flight = 100  # number of ocr requests kept running concurrently
+    kb_client.configure(pool_size=max_in_flight)
+
     # iterate over url files and extract ocrs for corresponding urls
     urls_filenames = gen_dir("urls", pattern=".*\.txt$")
     for urls_filename in urls_filenames:
 
-        print(f"retrieve ocr files ")
-
-        urls = gen_file_lines(
-            "urls/" + urls_filename
-        )  # generator of urls contained in urls_filename
-
-        ocrs: typing.Iterator = (
-            (url, ocr)
-            for url, ocr in gen_threaded(urls, f=get_ocr, chunk_size=100)
-            if ocr is not None  # remove failed get_ocr calls (or otherwise empty ocr files)
-        )  # iterator of (url:str, paragraphs:list) for each ocr file
-
         sav = f"ocrs/{urls_filename}"
         os.makedirs(os.path.dirname(sav), exist_ok=True)  # ensure sav dirs
 
-        # pass if sav exists
+        # pass if sav exists, i.e., only once completely downloaded
         if os.path.exists(sav):
             pass
         else:
-            lines = (
-                f"<ocr url={url}>" + "<par>".join(paragraphs) + "</ocr>" + "\n"
-                for url, paragraphs in tqdm(ocrs, total=10000)
+            print(f"retrieve ocr files for {urls_filename}")
+            harvest_ocrs(
+                "urls/" + urls_filename,
+                sav,
+                resume=args.resume,
+                max_in_flight=max_in_flight,
             )
 
-            with open(sav, "w") as f:
-                f.writelines(lines)
+    kb_client.print_stats()
+
+
+def harvest_ocrs(
+    urls_path: str,
+    sav: str,
+    *,
+    resume: bool = False,
+    max_in_flight: int = 100,
+    checkpoint_every: int = 100,
+) -> typing.NoReturn:
+    """Write an <ocr url=...>...</ocr> line to sav for each (non-empty) ocr of urls_path.
+
+    Ocrs are appended to sav + ".part". Every checkpoint_every completed urls,
+    the .part file is flushed to disk, and only then is a record of the .part
+    size and the offsets of those urls appended to the manifest, sav + ".manifest".
+    Hence, the manifest never references an ocr which is not on disk. On
+    completion, the .part file is atomically renamed to sav.
+
+    Args:
+        urls_path (str): file of line-separated ocr urls
+        sav (str): output file path
+        resume (bool): continue from the manifest, if any, rather than restart
+        max_in_flight (int): number of ocr requests kept running concurrently
+        checkpoint_every (int): number of completed urls per manifest update
+    """
+    part = sav + ".part"
+    manifest = sav + ".manifest"
+
+    completed, size = set(), 0  # completed url offsets, .part size at checkpoint
+    if resume and os.path.exists(manifest):
+        completed, size = get_manifest(manifest)
+        print(f"resuming after {len(completed)} completed urls")
+
+    # discard anything written after the last checkpoint (or everything, if not resuming)
+    with open(part, "ab") as f:
+        f.truncate(size)
+
+    # rewrite the manifest as a single record of the committed checkpoints, i.e., w/o any torn record
+    with open(manifest + ".temp", "w") as m:
+        if completed:
+            m.write(get_record(size, completed))
+        m.flush()
+        os.fsync(m.fileno())
+    os.replace(manifest + ".temp", manifest)
+
+    remaining: typing.Generator = (
+        (offset, url)
+        for offset, url in enumerate(gen_file_lines(urls_path))
+        if offset not in completed
+    )  # (url file line number, url) for urls yet to be retrieved
+
+    n_urls = sum(1 for _ in gen_file_lines(urls_path))
+
+    with open(part, "ab") as f, open(manifest, "a") as m:
+
+        checkpoint = []  # offsets completed since the last checkpoint
+        for (offset, url), paragraphs in tqdm(
+            gen_fetched(remaining, f=get_indexed_ocr, max_in_flight=max_in_flight),
+            total=n_urls,
+            initial=len(completed),
+        ):
+            # None: failed get_ocr calls (or otherwise empty ocr files)
+            if paragraphs is not None:
+                line = f"<ocr url={url}>" + "<par>".join(paragraphs) + "</ocr>" + "\n"
+                f.write(line.encode("utf8"))
+
+            checkpoint.append(offset)
+            if len(checkpoint) == checkpoint_every:
+                write_checkpoint(f, m, checkpoint)
+                checkpoint = []
+
+        write_checkpoint(f, m, checkpoint)
+
+    os.replace(part, sav)
+    os.remove(manifest)
+
+
+def write_checkpoint(f: typing.BinaryIO, m: typing.TextIO, offsets: typing.List):
+    """Flush the ocr .part file f to disk, then record its size and offsets in manifest m.
+
+    I.e., as a single record (line), written and flushed to disk at once.
+    """
+    if not offsets:
+        return
+
+    f.flush()
+    os.fsync(f.fileno())
+
+    m.write(get_record(f.tell(), offsets))
+    m.flush()
+    os.fsync(m.fileno())
+
+
+def get_record(size: int, offsets: typing.Iterable) -> str:
+    """Return a manifest record, e.g., "1024\t3\t0,1,2\n", of .part size, number of offsets, offsets."""
+    offsets = sorted(offsets)
+    return f"{size}\t{len(offsets)}\t{','.join(str(o) for o in offsets)}\n"
+
+
+def get_manifest(manifest: str) -> typing.Tuple[typing.Set, int]:
+    """Return (set of completed url offsets, .part size at the last checkpoint).
+
+    Only complete records are committed, i.e., a record torn by a crash (no
+    trailing newline, or fewer offsets than recorded), and any after it, are ignored.
+    """
+    completed, size = set(), 0
+    with open(manifest, "r") as m:
+        for line in m:
+            try:
+                if not line.endswith("\n"):
+                    raise ValueError("torn record")
+                size_at, n, offsets = line.rstrip("\n").split("\t")
+                offsets = [int(o) for o in offsets.split(",")]
+                if len(offsets) != int(n):
+                    raise ValueError("torn record")
+                size_at = int(size_at)
+            except ValueError:
+                break  # a record torn by the crash; later records are not to be trusted
+            completed.update(offsets)
+            size = size_at
+
+    return completed, size
+
+
+def get_indexed_ocr(item: typing.Tuple[int, str]) -> typing.Union[list, None]:
+    """Return get_ocr(url) for an (offset, url) item."""
+    offset, url = item
+    return get_ocr(url)
 
 
 def get_ocr(url: str) -> typing.Union[list, None]:
@@ -103,88 +259,6 @@ def gen_file_lines(path: str, *, strip="\n", apply=None) -> typing.Generator:
                 yield line.strip(strip)
 
 
-def get_response(url: str, *, max_attempts=5) -> requests.Response:
-    """Return the response.
-
-    Tries to get response max_attempts number of times, otherwise return None
-
-    Args:
-       url (str): url string to be retrieved
-       max_attemps (int): number of request attempts for same url
-
-    E.g.,
-        r = get_response(url)
-        r = xmltodict.parse(r.text)
-        # or
-        r = json.load(r.text)
-    """
-    for count, x in enumerate(range(max_attempts)):
-        try:
-            response = requests.get(url, timeout=10)
-            return response
-        except:
-            time.sleep(0.01)
-
-    # if count exceeded
-    return None
-
-
-def gen_threaded(
-    iterable: typing.Iterable,
-    *,
-    f: typing.Callable,
-    max_workers: int = None,
-    chunk_size=None,
-) -> typing.Generator:
-    """Return a generator yielding tuple (item, f(item)), for passed iterable.
-
-    For I/O intensive processes.
-    see: https://docs.python.org/3/library/concurrent.futures.html
-
-    Examples:
-        g = gen_threaded(urls, f=get_response)
-        url, response = next(g)
-
-        g = gen_threaded(urls, f=partial(get_response, max_attempts = 1))
-        url, response = next(g)
-
-    Args:
-        iter [iterable]:
-        f [callable]: Does not accept lambdas
-        chunk_size (int): concurrent.futures is greedy and will evaluate all of
-            the iterable at once. chunk_size limits the length of iterable
-            evaluated at any one time (and hence, loaded into memory).
-            [default: chunk_size=len(iterable)]
-    """
-    # concurrent.futures will greedily evaluate and store in memory, hence
-    # chunking to limit the scale of greedy evaluation
-    if chunk_size:
-        chunks = gen_chunks(iterable, chunk_size)
-    else:
-        chunks = map(lambda i: iterable, range(1))  # chunks contains a single chunk
-
-    for chunk in chunks:
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-
-            future_items = {executor.submit(f, item): item for item in chunk}
-
-            for future in concurrent.futures.as_completed(future_items):
-                yield (future_items[future], future.result())
-
-
-def gen_chunks(iterable: typing.Iterable, chunk_size: int) -> typing.Generator:
-    """Return a generator yielding chunks (as iterators) of passed iterable."""
-    it = iter(iterable)
-    while True:
-        chunk = itertools.islice(it, chunk_size)
-        try:
-            first_el = next(chunk)
-        except StopIteration:
-            return
-        yield itertools.chain((first_el,), chunk)
-
-
 def gen_map(iterable: typing.Iterable, *, f: typing.Callable) -> typing.Generator:
     """Return a generator yielding tuple (item, f(item)).
 
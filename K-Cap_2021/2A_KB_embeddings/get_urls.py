@@ -3,30 +3,62 @@ Randomnly sample ocr urls from KB jsru database.
 
 process:
     * i.e., article urls matching a query are split over multiple pages when a query is passed.  Urls are sampled by, i) imagining urls as splits of 1000 articles wide, sampling 1000 of these splits and taking 100 per split. This is done for each query. Hence, 100,000 per query are sampled.
+
+Run:
+    python3 get_urls.py [-seed 1]
 """
 
 
-import concurrent.futures
+import argparse
 import itertools
 import os
 import random
-import time
 import typing
 from pprint import pp
 
-import pydash
-import requests
-import xmltodict
 from tqdm import tqdm
 
+import kb_client
+import sru
+from harvest import gen_fetched
+from kb_client import get_response
+
+parser = argparse.ArgumentParser(
+    description="""Randomly sample the ocr urls of each query, output to urls/<query>.txt
+
+    The splits (and the urls of each split) sampled are seeded by -seed and the
+    query, s.t., a re-run with the same -seed requests the same splits, i.e.,
+    served from kb_cache.sqlite, and another -seed draws another sample.
+
+    Example:
+
+        python3 get_urls.py
+
+        python3 get_urls.py -seed 1
+    """,
+    formatter_class=argparse.RawTextHelpFormatter,
+)
+parser.add_argument(
+    "-seed",
+    nargs=1,
+    type=int,
+    default=[0],
+    help="seed of the sampled splits (with the query), for a reproducible sample [default: 0]",
+)
+
 
 def main():
 
+    args = parser.parse_args()
+
     # USER-SPECIFIED INPUTS
 
     split_width = 1000  # width of jsru split wrt., query
     n_splits = 1000  # number of splits to randomly sample
     per_split = 100  # number of urls to randomly sample per randomnly sampled split
+    max_in_flight = 50  # number of split requests kept running concurrently
+    cache_file = "kb_cache.sqlite"  # jsru responses cache, s.t., re-runs only fetch new splits
+    seed = args.seed[0]  # seed of the sampled splits (with the query), s.t., re-runs request (and cache) the same splits
 
     queries = [
         'type=artikel AND date within "1890-01-01 1899-12-31"',
@@ -39,6 +71,9 @@ def main():
 
     # END OF USER-SPECIFIC INPUTS
 
+    kb_client.configure(pool_size=max_in_flight)
+    kb_client.enable_cache(cache_file)
+
     # get number of available kb articles by decade
     # print("Available articles by decade:")
     # for query in queries:
@@ -59,16 +94,29 @@ def main():
             pass
         else:
             urls: typing.Generator = pan_for_gold(
-                query, split_width=split_width, n_splits=n_splits, per_split=per_split
+                query,
+                split_width=split_width,
+                n_splits=n_splits,
+                per_split=per_split,
+                max_in_flight=max_in_flight,
+                seed=seed,
             )
 
             with open(sav, "w") as f:
                 lines = (url + "\n" for url in tqdm(urls, total=n_splits * per_split))
                 f.writelines(lines)
 
+    kb_client.print_stats()
+
 
 def pan_for_gold(
-    query: str, *, split_width: int, n_splits: int, per_split: int
+    query: str,
+    *,
+    split_width: int,
+    n_splits: int,
+    per_split: int,
+    max_in_flight: int = 50,
+    seed: typing.Union[int, None] = None,
 ) -> typing.Iterator:
     """Return a generator of random ocr urls matching a jsru query.
 
@@ -81,6 +129,10 @@ def pan_for_gold(
         pool into splits (pans).
         * randomly sample 'n_splits' of these splits.
         * from each split randomnly sample 'per_split' articles
+
+    'max_in_flight' split requests are kept running continuously. Where seed is
+    passed, the same splits (and urls of each split) are sampled on each run,
+    i.e., re-runs request the same (cached) split urls.
     """
 
     # how large is our potential sampling pool?
@@ -89,7 +141,8 @@ def pan_for_gold(
 
     # conceptually, we imaging the pool in terms of splits of 'split_width'
     # get random startRecord values, analagous to randomly sampling splits
-    random_split_starts = random.sample(range(1, pool_size, split_width), k=n_splits)
+    rng = random if seed is None else random.Random(f"{seed}:{query}")
+    random_split_starts = rng.sample(range(1, pool_size, split_width), k=n_splits)
 
     base_url = (
         "http://jsru.kb.nl/sru/sru?version=1.2"
@@ -107,14 +160,19 @@ def pan_for_gold(
 
     random_splits: typing.Iterator = (
         (split_url, split)
-        for split_url, split in gen_threaded(
-            random_split_urls, f=get_page, chunk_size=50
+        for split_url, split in gen_fetched(
+            random_split_urls, f=get_page, max_in_flight=max_in_flight
         )
         if split is not None  # i.e., remove failed requests
     )  # iterator of (split_url, get_page(split_url))
 
     ocr_urls: typing.Iterator = itertools.chain.from_iterable(
-        get_split_urls(split_url, split, per_split)
+        get_split_urls(
+            split_url,
+            split,
+            per_split,
+            rng=random if seed is None else random.Random(f"{seed}:{split_url}"),
+        )
         for split_url, split in random_splits
     )  # iterator of urls (str) for all sampled random splits
 
@@ -122,7 +180,11 @@ def pan_for_gold(
 
 
 def get_split_urls(
-    split_url: str, split: typing.Union[tuple, None], sample_size: int
+    split_url: str,
+    split: typing.Union[tuple, None],
+    sample_size: int,
+    *,
+    rng: random.Random = random,
 ) -> typing.Generator:
     """Return random sample of urls from a split of articles.
 
@@ -130,11 +192,12 @@ def get_split_urls(
         split_url: the jsru query url from which split is taken
         split: the output from get_page(split_url)
         sample_size (int): how many samples from split to randomnly sample.
+        rng (random.Random):
     """
 
-    for article in random.sample(split, k=sample_size):
-        if pydash.objects.has(article, "srw:recordData.dc:identifier"):
-            url: str = article["srw:recordData"]["dc:identifier"]
+    for article in rng.sample(split, k=sample_size):
+        if "dc:identifier" in article:
+            url: str = article["dc:identifier"]
             yield url
         else:
             print(
@@ -142,13 +205,15 @@ def get_split_urls(
             )
 
 
-def get_page(url: str) -> typing.Union[tuple, None]:
-    """Return the articles on a jsru page."""
+def get_page(url: str) -> typing.Union[list, None]:
+    """Return the articles on a jsru page, as dicts of their record fields.
+
+    E.g., [{"dc:identifier": "http://resolver.kb.nl/...:ocr", "dc:title": ...}, ...]
+    """
     try:
-        response = get_response(url, max_attempts=3, timeout=20)
-        pan = xmltodict.parse(response.text)
+        response = get_response(url, max_attempts=3, timeout=20, stream=True)
 
-        return pan["srw:searchRetrieveResponse"]["srw:records"]["srw:record"]
+        return list(sru.gen_records(response))
 
     except:
         print(f"could not fetch: {url}")
@@ -164,102 +229,14 @@ def get_jsru_match_count(query: str) -> int:
         + "recordSchema=dc"
     )
 
-    r = get_response(base_url + "&startRecord=1&maximumRecords=1" + f"&query={(query)}")
-    r: dict = xmltodict.parse(r.text)
-    num_articles: int = int(r["srw:searchRetrieveResponse"]["srw:numberOfRecords"])
+    r = get_response(
+        base_url + "&startRecord=1&maximumRecords=1" + f"&query={(query)}",
+        stream=True,
+    )
+    num_articles: int = sru.get_number_of_records(r)
 
     return num_articles
 
 
-def gen_threaded(
-    iterable: typing.Iterable,
-    *,
-    f: typing.Callable,
-    max_workers: int = None,
-    chunk_size=None,
-) -> typing.Generator:
-    """Return a generator yielding tuple (item, f(item)), for passed iterable.
-
-    For I/O intensive processes.
-    see: https://docs.python.org/3/library/concurrent.futures.html
-
-    Examples:
-        g = gen_threaded(urls, f=get_response)
-        url, response = next(g)
-
-        g = gen_threaded(urls, f=partial(get_response, max_attempts = 1))
-        url, response = next(g)
-
-    Args:
-        iter [iterable]:
-        f [callable]: Does not accept lambdas
-        chunk_size (int): concurrent.futures is greedy and will evaluate all of
-            the iterable at once. chunk_size limits the length of iterable
-            evaluated at any one time (and hence, loaded into memory).
-            [default: chunk_size=len(iterable)]
-    """
-    # concurrent.futures will greedily evaluate and store in memory, hence
-    # chunking to limit the scale of greedy evaluation
-    if chunk_size:
-        chunks = gen_chunks(iterable, chunk_size)
-    else:
-        chunks = map(lambda i: iterable, range(1))  # chunks contains a single chunk
-
-    for chunk in chunks:
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-
-            future_items = {executor.submit(f, item): item for item in chunk}
-
-            for future in concurrent.futures.as_completed(future_items):
-                yield (future_items[future], future.result())
-
-
-def gen_chunks(iterable: typing.Iterable, chunk_size: int) -> typing.Generator:
-    """Return a generator yielding chunks (as iterators) of passed iterable."""
-    it = iter(iterable)
-    while True:
-        chunk = itertools.islice(it, chunk_size)
-        try:
-            first_el = next(chunk)
-        except StopIteration:
-            return
-        yield itertools.chain((first_el,), chunk)
-
-
-def get_response(url: str, *, max_attempts=5, **request_kwargs) -> requests.Response:
-    """Return the response.
-
-    Tries to get response max_attempts number of times, otherwise return None
-
-    Args:
-        url (str): url string to be retrieved
-        max_attemps (int): number of request attempts for same url
-        request_kwargs (dict): kwargs passed to requests.get()
-            timeout = 10 [default]
-
-    E.g.,
-        r = get_response(url, max_attempts=2, timeout=10)
-        r = xmltodict.parse(r.text)
-        # or
-        r = json.load(r.text)
-    """
-    # ensure requests.get(timeout=10) default unless over-ridden by kwargs
-    if "timeout" in request_kwargs:
-        pass
-    else:
-        request_kwargs["timeout"] = 10
-
-    for count, x in enumerate(range(max_attempts)):
-        try:
-            response = requests.get(url, **request_kwargs)
-            return response
-        except:
-            time.sleep(0.01)
-
-    # if count exceeded
-    return None
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,138 @@
+"""
+asyncio fetch engine for the KB harvesters.
+
+Keeps max_in_flight calls of f running continuously (a sliding window): a new
+item is started as soon as any call completes, rather than waiting on the
+slowest item of each chunk before the next chunk begins. Calls to the same
+host can be rate limited (requests per second).
+
+The (blocking) calls of f run in worker threads, such that f may use the
+pooled kb_client session; results are yielded in completion order.
+
+Example:
+    for url, response in gen_fetched(urls, f=get_response, max_in_flight=50):
+        ...
+
+    g = gen_fetched(urls, f=get_page, rate_limits={"jsru.kb.nl": 20})
+    url, page = next(g)
+
+Note: kept identical in build_scripts/sample_1 and K-Cap_2021/2A_KB_embeddings
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import typing
+import urllib.parse
+
+
+def gen_fetched(
+    iterable: typing.Iterable,
+    *,
+    f: typing.Callable,
+    max_in_flight: int = 50,
+    rate_limits: typing.Dict[str, float] = None,
+    key: typing.Callable = None,
+) -> typing.Generator:
+    """Return a generator yielding tuple (item, f(item)), for passed iterable.
+
+    The iterable is consumed lazily, i.e., only max_in_flight items are held
+    at any one time.
+
+    Args:
+        iterable: items (e.g., urls) to be passed to f
+        f (callable): blocking function, e.g., get_response
+        max_in_flight (int): global cap on concurrent calls of f
+        rate_limits (dict): {host: max calls per second}, for hosts to be throttled
+        key (callable): return the host of an item [default: url netloc of str items]
+    """
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+    limiters = {host: RateLimiter(rate) for host, rate in (rate_limits or {}).items()}
+    results = fetch(
+        iterable,
+        f=f,
+        max_in_flight=max_in_flight,
+        limiters=limiters,
+        key=key or get_host,
+        executor=executor,
+    )
+
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(results.aclose())
+        executor.shutdown(wait=True, cancel_futures=True)
+        loop.close()
+
+
+async def fetch(
+    iterable: typing.Iterable,
+    *,
+    f: typing.Callable,
+    max_in_flight: int,
+    limiters: typing.Dict,
+    key: typing.Callable,
+    executor: concurrent.futures.Executor,
+) -> typing.AsyncGenerator:
+    """Yield (item, f(item)) as calls complete, keeping max_in_flight calls running."""
+    loop = asyncio.get_running_loop()
+    items = iter(iterable)
+
+    async def call(item):
+        limiter = limiters.get(key(item))
+        if limiter:
+            await limiter.wait()
+        return item, await loop.run_in_executor(executor, f, item)
+
+    # fill the window
+    in_flight = set()
+    for item in items:
+        in_flight.add(loop.create_task(call(item)))
+        if len(in_flight) == max_in_flight:
+            break
+
+    try:
+        while in_flight:
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            # top the window up before handing back results
+            for item in itertools.islice(items, len(done)):
+                in_flight.add(loop.create_task(call(item)))
+
+            for task in done:
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+class RateLimiter(object):
+    """Space successive calls to wait() at least 1/rate seconds apart.
+
+    Args:
+        rate (float): maximum number of calls per second
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+
+def get_host(item) -> typing.Union[str, None]:
+    """Return the host of a url item, else None (i.e., not rate limited)."""
+    if isinstance(item, str):
+        return urllib.parse.urlsplit(item).netloc
+    return None
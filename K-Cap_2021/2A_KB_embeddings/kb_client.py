@@ -0,0 +1,222 @@
+"""
+Shared HTTP client for the KB (jsru.kb.nl, services.kb.nl) and api.europeana.eu harvesters.
+
+A single requests.Session is shared by every thread of the process, such that
+connections are pooled per host and kept alive between requests, rather than
+paying a TCP handshake for each of the (hundreds of thousands of) requests.
+Per-host request, error and latency counters are collected along the way.
+
+Once enable_cache() is called, responses from CACHED_HOSTS (the SRU search
+and OAI endpoints) are served from, and stored in, an on-disk ResponseCache.
+Streamed (stream=True) responses are compressed as they are read, and stored
+only once read in full, s.t., the body is never held in memory uncompressed.
+
+Example:
+    from kb_client import enable_cache, get_response, print_stats
+
+    enable_cache("kb_cache.sqlite")
+    r = get_response(url, max_attempts=2, timeout=10)
+    r = xmltodict.parse(r.text)
+    ...
+    print_stats()
+
+Note: kept identical in build_scripts/sample_1 and K-Cap_2021/2A_KB_embeddings
+"""
+import threading
+import time
+import typing
+import urllib.parse
+import zlib
+from collections import defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from response_cache import ResponseCache
+
+POOL_SIZE = 50  # connections kept alive per host, i.e., >= the number of worker threads
+POOL_HOSTS = 10  # number of hosts for which connection pools are kept
+CACHED_HOSTS = {"jsru.kb.nl", "services.kb.nl"}  # hosts whose responses are cached
+
+_session: typing.Union[requests.Session, None] = None
+_session_lock = threading.Lock()
+
+_cache: typing.Union[ResponseCache, None] = None
+
+_stats: typing.DefaultDict = defaultdict(
+    lambda: {"requests": 0, "errors": 0, "seconds": 0.0, "cache_hits": 0}
+)  # {host: {"requests": int, "errors": int, "seconds": float, "cache_hits": int}}
+_stats_lock = threading.Lock()
+
+
+def configure(*, pool_size: int = POOL_SIZE) -> typing.NoReturn:
+    """(Re)create the shared session with a per-host pool of pool_size connections.
+
+    Call with the number of worker threads used, before any request is made.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = new_session(pool_size)
+
+
+def enable_cache(path: str, **cache_kwargs) -> typing.NoReturn:
+    """Serve and store responses from CACHED_HOSTS via a ResponseCache at path.
+
+    Args:
+        path (str): SQLite file of the cache, e.g., "kb_cache.sqlite"
+        cache_kwargs (dict): ttl, max_bytes; see ResponseCache
+    """
+    global _cache
+
+    _cache = ResponseCache(path, **cache_kwargs)
+
+
+def get_session() -> requests.Session:
+    """Return the shared session, creating it (with POOL_SIZE) on first use."""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = new_session(POOL_SIZE)
+        return _session
+
+
+def new_session(pool_size: int) -> requests.Session:
+    """Return a keep-alive session with connection pools of pool_size per host."""
+    adapter = HTTPAdapter(
+        pool_connections=POOL_HOSTS, pool_maxsize=pool_size, max_retries=0
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+
+    return session
+
+
+def get_response(
+    url: str, *, max_attempts=5, cache: bool = True, **request_kwargs
+) -> typing.Union[requests.Response, None]:
+    """Return the response.
+
+    Tries to get response max_attempts number of times, otherwise return None.
+    Where the cache is enabled, (successful) responses from CACHED_HOSTS are
+    returned from the cache where available, and cached otherwise.
+
+    Args:
+        url (str): url string to be retrieved
+        max_attemps (int): number of request attempts for same url
+        cache (bool): False, to neither serve nor store url via the cache, e.g., for oai resumption tokens
+        request_kwargs (dict): kwargs passed to requests.Session.get()
+            timeout = 10 [default]
+
+    E.g.,
+        r = get_response(url, max_attempts=2, timeout=10)
+        r = xmltodict.parse(r.text)
+        # or
+        r = json.load(r.text)
+    """
+    # ensure timeout=10 default unless over-ridden by kwargs
+    request_kwargs.setdefault("timeout", 10)
+
+    session = get_session()
+    host = urllib.parse.urlsplit(url).netloc
+
+    cache = (
+        _cache
+        if cache and urllib.parse.urlsplit(url).hostname in CACHED_HOSTS
+        else None
+    )
+    if cache:
+        response = cache.get(url)
+        if response is not None:
+            record_hit(host)
+            return response
+
+    # try max_attempts times
+    for attempt in range(max_attempts):
+        start = time.perf_counter()
+        try:
+            response = session.get(url, **request_kwargs)
+            record(host, time.perf_counter() - start, error=response.status_code >= 400)
+            if cache and response.status_code == 200:
+                if request_kwargs.get("stream"):
+                    cache_when_read(url, response, cache)
+                else:
+                    cache.put(url, response)
+            return response
+        except requests.RequestException:
+            record(host, time.perf_counter() - start, error=True)
+            time.sleep(0.01)
+
+    # if count exceeded
+    return None
+
+
+def cache_when_read(
+    url: str, response: requests.Response, cache: ResponseCache
+) -> typing.NoReturn:
+    """Cache a streamed response once (and only if) its body is read in full.
+
+    I.e., response.iter_content (also used by response.content) is wrapped,
+    s.t., chunks are compressed as they are yielded.
+    """
+    iter_content = response.iter_content
+
+    def gen_chunks(chunk_size=1, decode_unicode=False):
+        if decode_unicode:
+            yield from iter_content(chunk_size=chunk_size, decode_unicode=True)
+            return
+
+        compressor = zlib.compressobj()
+        body = []
+        for chunk in iter_content(chunk_size=chunk_size):
+            body.append(compressor.compress(chunk))
+            yield chunk
+        body.append(compressor.flush())
+
+        cache.put(url, response, body=b"".join(body))
+
+    response.iter_content = gen_chunks
+
+
+def record(host: str, seconds: float, *, error: bool = False) -> typing.NoReturn:
+    """Add a request (and its latency) to the counters of host."""
+    with _stats_lock:
+        _stats[host]["requests"] += 1
+        _stats[host]["seconds"] += seconds
+        if error:
+            _stats[host]["errors"] += 1
+
+
+def record_hit(host: str) -> typing.NoReturn:
+    """Add a response served from the cache to the counters of host."""
+    with _stats_lock:
+        _stats[host]["cache_hits"] += 1
+
+
+def get_stats() -> typing.Dict:
+    """Return {host: {"requests", "errors", "mean_latency", "cache_hits"}} for all hosts requested."""
+    with _stats_lock:
+        return {
+            host: {
+                "requests": s["requests"],
+                "errors": s["errors"],
+                "mean_latency": s["seconds"] / s["requests"] if s["requests"] else 0.0,
+                "cache_hits": s["cache_hits"],
+            }
+            for host, s in _stats.items()
+        }
+
+
+def print_stats() -> typing.NoReturn:
+    """Print the per-host request counters."""
+    for host, s in get_stats().items():
+        print(
+            f"\t{host}: {s['requests']} requests, {s['errors']} errors, "
+            + f"{s['mean_latency']:.3f}s mean latency, {s['cache_hits']} cache hits"
+        )
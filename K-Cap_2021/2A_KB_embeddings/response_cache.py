@@ -0,0 +1,190 @@
+"""
+Persistent on-disk cache of http responses, keyed by normalized request url.
+
+Responses are stored zlib-compressed in a single SQLite file. Entries expire
+after ttl seconds, and the least recently used entries are evicted whenever
+the (compressed) cache exceeds max_bytes.
+
+Example:
+    cache = ResponseCache("kb_cache.sqlite", ttl=30 * 24 * 3600)
+
+    response = cache.get(url)
+    if response is None:
+        response = requests.get(url)
+        cache.put(url, response)
+
+Note: kept identical in build_scripts/sample_1 and K-Cap_2021/2A_KB_embeddings
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import typing
+import urllib.parse
+import zlib
+
+import requests
+
+
+class ResponseCache(object):
+    """A size-bounded LRU cache of (status code, encoding, body) by request url.
+
+    Args:
+        path (str): the SQLite file to store the cache in (created if absent)
+        ttl (float): seconds after which an entry is stale [default: 30 days, None: never]
+        max_bytes (int): maximum total size of the compressed bodies [default: 2GB]
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        ttl: typing.Union[float, None] = 30 * 24 * 3600,
+        max_bytes: int = 2 * 1024**3,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                status INTEGER,
+                encoding TEXT,
+                body BLOB,
+                size INTEGER,
+                stored REAL,
+                accessed REAL
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self.db.commit()
+
+        self.size: int = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, url: str) -> typing.Union[requests.Response, None]:
+        """Return the cached response for url, or None if absent or stale."""
+        key = get_key(url)
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, encoding, body, stored FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            status, encoding, body, stored = row
+            now = time.time()
+            if self.ttl is not None and now - stored > self.ttl:
+                self.delete(key)
+                return None
+
+            self.db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self.db.commit()
+
+        response = requests.Response()
+        response.url = url
+        response.status_code = status
+        response.encoding = encoding
+        response._content = zlib.decompress(body)
+        response._content_consumed = True
+
+        return response
+
+    def put(
+        self, url: str, response: requests.Response, *, body: bytes = None
+    ) -> typing.NoReturn:
+        """Store the response for url, evicting least recently used entries if full.
+
+        Args:
+            url (str):
+            response (requests.Response):
+            body (bytes): the zlib-compressed body of response, where already
+                compressed (e.g., as streamed), rather than read from response.content
+        """
+        key = get_key(url)
+        if body is None:
+            body = zlib.compress(response.content)
+        now = time.time()
+
+        with self.lock:
+            self.delete(key)
+            self.db.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    url,
+                    response.status_code,
+                    response.encoding,
+                    body,
+                    len(body),
+                    now,
+                    now,
+                ),
+            )
+            self.size += len(body)
+            self.evict()
+            self.db.commit()
+
+    def delete(self, key: str) -> typing.NoReturn:
+        """Remove an entry (if present). Call with self.lock held."""
+        row = self.db.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row:
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size -= row[0]
+
+    def evict(self) -> typing.NoReturn:
+        """Remove least recently used entries until within max_bytes. Call with self.lock held."""
+        while self.size > self.max_bytes:
+            oldest = self.db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 100"
+            ).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    break
+
+    def close(self) -> typing.NoReturn:
+        with self.lock:
+            self.db.close()
+
+
+def normalize_url(url: str) -> str:
+    """Return url with lower-cased scheme and host, sorted query parameters and no fragment.
+
+    E.g., the following are equivalent:
+        http://JSRU.kb.nl/sru/sru?version=1.2&query=(blank)
+        http://jsru.kb.nl/sru/sru?query=%28blank%29&version=1.2
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+
+    return urllib.parse.urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path or "/",
+            urllib.parse.urlencode(query),
+            "",
+        )
+    )
+
+
+def get_key(url: str) -> str:
+    """Return the cache key (sha256 hex digest) of the normalized url."""
+    return hashlib.sha256(normalize_url(url).encode("utf8")).hexdigest()
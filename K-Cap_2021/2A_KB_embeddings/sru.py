@@ -0,0 +1,108 @@
+"""
+Incremental parsing of jsru.kb.nl SRU searchRetrieve responses.
+
+Records are yielded as the response body is read (e.g., chunk by chunk from a
+streamed http response), and the parsed xml of each record is discarded once
+yielded. I.e., the whole page is never held as a (nested dict) tree.
+
+Example:
+    response = get_response(url, stream=True)
+    for record in gen_records(response):
+        record["dc:identifier"]  # http://resolver.kb.nl/resolve?urn=ddd:010567709:mpeg21:a0493:ocr
+
+    n = get_number_of_records(get_response(count_url, stream=True))
+
+Note: kept identical in build_scripts/sample_1 and K-Cap_2021/2A_KB_embeddings
+"""
+import typing
+import xml.etree.ElementTree as ET
+
+SRW = "http://www.loc.gov/zing/srw/"
+CHUNK_SIZE = 64 * 1024
+
+
+def gen_records(body, *, chunk_size: int = CHUNK_SIZE) -> typing.Generator:
+    """Yield a dict of the recordData fields of each srw:record, as it is parsed.
+
+    E.g., {"dc:identifier": "http://resolver.kb.nl/...:ocr", "dc:title": "...", ...}
+    where fields are named by their prefix, as declared in the response, and
+    repeated fields are collected in a list.
+
+    Args:
+        body: a (streamed) requests.Response, or an iterable of bytes chunks
+        chunk_size (int): bytes read from a response at a time
+    """
+    record_tag = "{" + SRW + "}record"
+    data_tag = "{" + SRW + "}recordData"
+
+    prefixes = {}  # {namespace uri: prefix}
+    for event, elem in gen_events(body, chunk_size=chunk_size):
+        if event == "start-ns":
+            prefix, uri = elem
+            prefixes[uri] = prefix
+
+        elif elem.tag == record_tag:
+            record = {}
+            data = elem.find(data_tag)
+            for field in data if data is not None else []:
+                add_field(record, get_name(field.tag, prefixes), field.text)
+
+            elem.clear()  # discard the parsed record
+            yield record
+
+
+def get_number_of_records(body, *, chunk_size: int = CHUNK_SIZE) -> int:
+    """Return srw:numberOfRecords, reading the response only as far as needed.
+
+    Args:
+        body: a (streamed) requests.Response, or an iterable of bytes chunks
+        chunk_size (int): bytes read from a response at a time
+    """
+    tag = "{" + SRW + "}numberOfRecords"
+
+    events = gen_events(body, chunk_size=chunk_size)
+    try:
+        for event, elem in events:
+            if event == "end" and elem.tag == tag:
+                return int(elem.text)
+    finally:
+        events.close()
+        if hasattr(body, "close"):
+            body.close()  # i.e., return the connection to the pool
+
+    raise ValueError("no srw:numberOfRecords in response")
+
+
+def gen_events(body, *, chunk_size: int) -> typing.Generator:
+    """Yield ("start-ns", (prefix, uri)) and ("end", element) events of an xml body."""
+    if hasattr(body, "iter_content"):
+        chunks = body.iter_content(chunk_size=chunk_size)
+    else:
+        chunks = body
+
+    parser = ET.XMLPullParser(events=("start-ns", "end"))
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
+
+    parser.close()
+    yield from parser.read_events()
+
+
+def get_name(tag: str, prefixes: typing.Dict) -> str:
+    """Return e.g., "dc:identifier" for "{http://purl.org/dc/elements/1.1/}identifier"."""
+    if tag.startswith("{"):
+        uri, local = tag[1:].split("}", 1)
+        prefix = prefixes.get(uri)
+        return f"{prefix}:{local}" if prefix else local
+    return tag
+
+
+def add_field(record: typing.Dict, name: str, value: str) -> typing.NoReturn:
+    """Add a field to record, collecting repeated fields in a list."""
+    if name not in record:
+        record[name] = value
+    elif isinstance(record[name], list):
+        record[name].append(value)
+    else:
+        record[name] = [record[name], value]
@@ -1,105 +1,257 @@
-""" Generate 60 sheets of 50 samples.
+""" Generate 60 sheets (blocks) of 50 samples, see "python3 make_blocks.py -h"
     20:20:5:5 ; positive:negative:additional:control
 
 run
 ```
-python3.py make_blocks.py
+python3 make_blocks.py
+
+python3 make_blocks.py -n_blocks 1000 -block_size 50 -ratios 20 20 5 5 -seed 1
 ```
 
 Requires:
-    * 
-"""
+    * ../sample_2/{contentious,alternative,additional}_words/sampled.csv, see sample_2/PIPELINE.py
+    * control.csv, a csv of url, query word, text for each control sample
+    * huc_study.csv (optional), extracts used in a previous study, not to be reused
+
+Output:
+    blocks.csv, of a row per extract, the rows of each block consecutive:
 
+    ,url,query,extract,class,metadata,block
 
+    where class is p (positive), n (negative), a (additional) or c (control),
+    and block the index of the block (from 0)
+"""
+
+import argparse
 import csv
+import hashlib
+import itertools
+import os
 import random
 import typing
-from copy import copy
 
-import pandas as pd
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""Generate blocks of extracts, in the ratio positive:negative:additional:control
+
+    Extracts are pulled in order from the (pre-shuffled) sampled.csv of each
+    stream, skipping any extract (i.e., url, query and extract text) already
+    in a block, in control.csv or in huc_study.csv.
+
+    Example:
+        python3 make_blocks.py -n_blocks 60 -block_size 50 -ratios 20 20 5 5
+    """,
+)
+parser.add_argument(
+    "-n_blocks", nargs=1, type=int, default=[60], help="number of blocks"
+)
+parser.add_argument(
+    "-block_size", nargs=1, type=int, default=[50], help="number of extracts per block"
+)
+parser.add_argument(
+    "-ratios",
+    nargs=4,
+    type=int,
+    default=[20, 20, 5, 5],
+    metavar=("P", "N", "A", "C"),
+    help="ratio of positive:negative:additional:control extracts in each block",
+)
+parser.add_argument(
+    "-seed",
+    nargs=1,
+    type=int,
+    help="seed of the shuffle of each block, for reproducible blocks",
+)
+parser.add_argument(
+    "-positive",
+    nargs=1,
+    default=["../sample_2/contentious_words/sampled.csv"],
+    help="sampled.csv of positive (contentious) extracts",
+)
+parser.add_argument(
+    "-negative",
+    nargs=1,
+    default=["../sample_2/alternative_words/sampled.csv"],
+    help="sampled.csv of negative (alternative) extracts",
+)
+parser.add_argument(
+    "-additional",
+    nargs=1,
+    default=["../sample_2/additional_words/sampled.csv"],
+    help="sampled.csv of additional extracts",
+)
+parser.add_argument(
+    "-control", nargs=1, default=["control.csv"], help="csv of control extracts"
+)
+parser.add_argument(
+    "-huc",
+    nargs=1,
+    default=["huc_study.csv"],
+    help="csv of extracts used in a previous study",
+)
+parser.add_argument("-sav", nargs=1, default=["blocks.csv"], help="output csv")
+
+CLASSES = ["p", "n", "a", "c"]  # i.e., positive, negative, additional, control
+HEADER = ["", "url", "query", "extract", "class", "metadata", "block"]
 
 
 def main():
 
-    # ------
-    # import the sampled extracts
-    # ------
-    negative = gen_csv_rows(
-        "../sample_2/alternative_words/sampled.csv", ignore_rows=[0]
-    )
+    args = parser.parse_args()
+    rng = random.Random(args.seed[0] if args.seed else None)
 
-    positive = gen_csv_rows(
-        "../sample_2/contentious_words/sampled.csv", ignore_rows=[0]
-    )
+    block_size = args.block_size[0]
+    counts = dict(zip(CLASSES, get_counts(args.ratios, block_size)))
+    print(f"{block_size} extracts per block, i.e., {counts}")
 
-    additional = gen_csv_rows(
-        "../sample_2/additional_words/sampled.csv", ignore_rows=[0]
-    )
+    # ------
+    # import the sampled extracts, lazily ... the csv files are pre-shuffled,
+    # we just pull our results in order to each block
+    # ------
+    streams = {
+        "p": gen_csv_rows(args.positive[0], ignore_rows=[0]),
+        "n": gen_csv_rows(args.negative[0], ignore_rows=[0]),
+        "a": gen_csv_rows(args.additional[0], ignore_rows=[0]),
+    }
 
-    control = list(gen_csv_rows("control.csv", ignore_rows=[0]))
+    control = get_control(args.control[0], counts["c"])
 
-    huc = list(
-        gen_csv_rows("huc_study.csv", ignore_rows=[0])
-    )  # extracts used in previous study
+    # keys of extracts not to be (re)used, i.e., controls, those of a previous study, and those in a block
+    seen: typing.Set = {get_key(row) for row in control}
+    if os.path.exists(args.huc[0]):
+        seen.update(get_key(row) for row in gen_csv_rows(args.huc[0], ignore_rows=[0]))
+    else:
+        print(f"notice: {args.huc[0]} does not exist")
 
     # ------
-    # the csv files are pre-shuffled ...
-    # we just pull our results in order ... to each form
+    # assemble and write blocks, one at a time
     # ------
+    considered = {row_class: 0 for row_class in streams}  # i.e., counters of each type
+
+    with open(args.sav[0], "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+
+        n_blocks = 0
+        for block in gen_blocks(
+            streams, control, counts=counts, seen=seen, considered=considered, rng=rng
+        ):
+            writer.writerows(row + [n_blocks] for row in block)
+            n_blocks += 1
+            if n_blocks == args.n_blocks[0]:
+                break
+
+    if n_blocks < args.n_blocks[0]:
+        print(f"notice: extracts exhausted, only {n_blocks} of {args.n_blocks[0]} blocks")
 
-    # keep counters of each type
-    counter_n = 0
-    counter_p = 0
-    counter_a = 0
-
-    collected: typing.List = [["", "url", "query", "extract"]]
-
-    for i in range(60):
-
-        # create new list and append control
-        temp: list = []
-        temp += [c + ["c"] for c in control]
-        print(temp)
-        exit(1)
-
-        # add next 20 negative not previously seen in temp or huc
-        counter = 0
-        while counter < 20:
-            potential = next(negative)
-            counter_n += 1
-            if potential not in temp and potential not in huc:
-                temp.append(potential + ["n"])
-                counter += 1
-
-        # add next 10 positive not previously seen in temp or huc
-        counter = 0
-        while counter < 20:
-            potential = next(positive)
-            counter_p += 1
-            if potential not in temp and potential not in huc:
-                temp.append(potential + ["p"])
-                counter += 1
-
-        # add next 10 additional not previously seen in temp or huc
-        counter = 0
-        while counter < 5:
-            potential = next(additional)
-            counter_a += 1
-            if potential not in temp and potential not in huc:
-                temp.append(potential + ["a"])
-                counter += 1
+    for row_class, count in considered.items():
+        print(f"{count} {row_class} extracts considered")
+
+
+def gen_blocks(
+    streams: typing.Dict,
+    control: typing.List,
+    *,
+    counts: typing.Dict,
+    seen: typing.Set,
+    considered: typing.Dict = None,
+    rng: random.Random = random,
+) -> typing.Generator:
+    """Yield blocks of [idx, url, query, extract, class, metadata] rows, until a stream is exhausted.
+
+    Each block takes counts[class] unseen rows of each stream (in order), and
+    the control rows, randomly shuffled.
+
+    Args:
+        streams (dict): {class: iterator of sampled.csv rows}, e.g., {"p": ..., "n": ..., "a": ...}
+        control (list): control.csv rows, i.e., added to every block
+        counts (dict): {class: number of rows per block}
+        seen (set): keys (see get_key) of rows not to be used, updated with the rows used
+        considered (dict): {class: number of rows pulled from the stream}, updated in-place
+        rng (random.Random):
+    """
+    control_rows = [get_row(row, "c") for row in control]
+
+    while True:
+
+        # create new block and append control
+        block: typing.List = list(control_rows)
+
+        # add the next unseen rows of each stream
+        for row_class, stream in streams.items():
+            rows = take_unseen(stream, counts[row_class], seen, considered, row_class)
+            if len(rows) < counts[row_class]:
+                return
+            block += [get_row(row, row_class) for row in rows]
 
         # randomly shuffle this
-        random.shuffle(temp)
-        collected += temp
+        rng.shuffle(block)
+        yield block
+
+
+def take_unseen(
+    rows: typing.Iterator,
+    n: int,
+    seen: typing.Set,
+    considered: typing.Dict = None,
+    row_class: str = None,
+) -> typing.List:
+    """Return the next n rows whose keys are not in seen (or fewer, where rows are exhausted), adding their keys to seen."""
+    taken = []
+    if n == 0:
+        return taken
+
+    for row in rows:
+        if considered is not None:
+            considered[row_class] += 1
+
+        key = get_key(row)
+        if key not in seen:
+            seen.add(key)
+            taken.append(row)
+            if len(taken) == n:
+                break
+
+    return taken
+
+
+def get_key(row: typing.List) -> typing.Tuple[str, str, str]:
+    """Return (url, query, sha1 digest of extract) of an [idx, url, query, extract, ...] row."""
+    return (row[1], row[2], hashlib.sha1(row[3].encode("utf-8")).hexdigest())
 
-    print(f"{counter_n} negative extracts considered")
-    print(f"{counter_p} positive extracts considered")
-    print(f"{counter_a} additional extracts considered")
 
-    with open("blocks.csv", "w") as f:
-        write = csv.writer(f)
-        write.writerows(collected)
+def get_row(row: typing.List, row_class: str) -> typing.List:
+    """Return [idx, url, query, extract, class, metadata] of an [idx, url, query, extract(, metadata)] row."""
+    metadata = row[4] if len(row) > 4 else ""
+    return row[:4] + [row_class, metadata]
+
+
+def get_control(path: str, n: int) -> typing.List:
+    """Return the first n rows of the control csv at path."""
+    control = list(itertools.islice(gen_csv_rows(path, ignore_rows=[0]), n))
+    if len(control) < n:
+        print(f"notice: only {len(control)} of {n} control extracts in {path}")
+
+    return control
+
+
+def get_counts(ratios: typing.List[int], block_size: int) -> typing.List[int]:
+    """Return the number of extracts of each ratio in a block of block_size.
+
+    E.g., [20, 20, 5, 5] of 50 for ratios [20, 20, 5, 5] and [40, 40, 10, 10] for
+    100, where counts not exactly divisible are rounded by largest remainder.
+    """
+    total = sum(ratios)
+    counts = [block_size * ratio // total for ratio in ratios]
+    remainders = sorted(
+        range(len(ratios)),
+        key=lambda i: block_size * ratios[i] % total,
+        reverse=True,
+    )
+    for i in remainders[: block_size - sum(counts)]:
+        counts[i] += 1
+
+    return counts
 
 
 def gen_csv_rows(path: str, *, ignore_rows: list = []) -> typing.Generator:
@@ -117,9 +269,5 @@ def gen_csv_rows(path: str, *, ignore_rows: list = []) -> typing.Generator:
                 yield line
 
 
-def max_index(input: typing.List) -> int:
-    return len(input) - 1
-
-
 if __name__ == "__main__":
     main()
@@ -1,82 +1,172 @@
 """
-Double check the number of contentious, alternative, additional and control extracts in each block.
+Double check the number of contentious, alternative, additional and control extracts in each block, see "python3 profile_blocks.py -h"
+
+I.e., profile blocks.csv (see make_blocks.py, schedule_blocks.py) in a single
+pass, as a single (long format) csv, profile_blocks.csv, of
+
+    section,block,class,key,count
+
+where section is one of:
+
+    class: the number of extracts of each class in each block
+    query: the number of extracts of each query word of each class (over all blocks, i.e., block is empty)
+    duplicate: the number of times an extract (key, i.e., url|query|digest) occurs in blocks.csv, where more than once, of any class (controls excluded)
+    duplicate_block: the number of times each duplicate extract (key, i.e., url|query|digest) occurs in each block
+
+where digest is the (first 10 hex digits of the) sha1 digest of the extract text, as make_blocks.get_key
+    decade: the number of extracts of each decade of each class in each block
+    spatial: the number of extracts of each spatial distribution of each class in each block
+
+Example:
+    python3 profile_blocks.py
+
+    df = pd.read_csv("profile_blocks.csv")
+    df[df.section == "class"].pivot(index="block", columns="class", values="count")
 """
 
-import csv
-import typing
-from collections import Counter
+import argparse
+import hashlib
 
+import pandas as pd
 
-def main():
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""Profile the blocks of blocks.csv, output as profile_blocks.csv
 
-    # ------
-    # get counts of p, n, a and c in each block of 50
-    # ------
-    records = [["block", "n_count", "p_count", "c_count", "a_count"]]
-    block_record = [0, 0, 0, 0, 0]
-    for index, row in enumerate(gen_csv_rows("blocks.csv", ignore_rows=[0]), start=1):
-
-        row_class = row[4]
-        if row_class == "n":
-            block_record[1] += 1
-        elif row_class == "p":
-            block_record[2] += 1
-        elif row_class == "c":
-            block_record[3] += 1
-        elif row_class == "a":
-            block_record[4] += 1
-
-        if index // 50 != block_record[0]:
-            records.append(block_record)
-            block_record = [index // 50, 0, 0, 0, 0]
-
-    with open("profile_blocks.csv", "w") as f:
-        write = csv.writer(f)
-        write.writerows(records)
+    Example:
+        python3 profile_blocks.py -f blocks.csv -sav profile_blocks.csv
+    """,
+)
+parser.add_argument("-f", nargs=1, default=["blocks.csv"], help="blocks csv")
+parser.add_argument(
+    "-block_size",
+    nargs=1,
+    type=int,
+    default=[50],
+    help="number of extracts per block, where blocks.csv has no block column",
+)
+parser.add_argument(
+    "-sav", nargs=1, default=["profile_blocks.csv"], help="output csv"
+)
 
-    # ------
-    # whats the word coverage like in each of our streams?
-    # ------
+COLUMNS = ["section", "block", "class", "key", "count"]
 
-    matches_p = Counter()
-    matches_n = Counter()
 
-    for index, row in enumerate(gen_csv_rows("blocks.csv", ignore_rows=[0])):
+def main():
+
+    args = parser.parse_args()
 
-        query = row[2]
-        row_class = row[4]  # i.e.,  'p', 'n', 'a', 'c'
+    df = get_blocks(args.f[0], block_size=args.block_size[0])
+    print(f"{len(df)} extracts in {df['block'].nunique()} blocks")
 
-        if row_class == 'p':
-            matches_p[query] += 1
-        elif row_class == 'n':
-            matches_n[query] += 1
+    profile = get_profile(df)
+    profile.to_csv(args.sav[0], index=False)
 
-    with open("profile_blocks_matching_n.csv", "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(['query word', 'count'])
-        for query, count in dict(matches_n).items():
-            writer.writerow([query, count])
+    # ------
+    # summarise
+    # ------
+    class_counts = profile[profile["section"] == "class"].pivot(
+        index="block", columns="class", values="count"
+    )
+    print(class_counts.describe().loc[["min", "max"]])
 
-    with open("profile_blocks_matching_p.csv", "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(['query word', 'count'])
-        for query, count in dict(matches_p).items():
-            writer.writerow([query, count])
+    n_duplicates = (profile["section"] == "duplicate").sum()
+    if n_duplicates:
+        print(f"notice: {n_duplicates} extracts occur more than once in {args.f[0]}")
 
 
-def gen_csv_rows(path: str, *, ignore_rows: typing.List = []):
-    """Return a generator yielding successive csv rows.
+def get_blocks(path: str, *, block_size: int = 50) -> pd.DataFrame:
+    """Return the rows of a blocks csv, with a block, decade and spatial column.
 
-    Will ignore row indices specified in ignore_rows arg.
+    Where the csv has no block column (i.e., as output by make_blocks.py
+    before it was added), blocks are consecutive block_size rows. Where it has
+    no class column (i.e., the header ,url,query,extract, of the earlier
+    make_blocks.py), class is the 5th column, by position.
 
     Args:
-        path (str): path to csv
-        ignore_rows (list): E.g., title row = [0]
+        path (str): e.g., blocks.csv of ,url,query,extract,class(,metadata,block) rows
+        block_size (int): number of rows per block
     """
-    with open(path, "r") as f:
-        for index, line in enumerate(csv.reader(f)):
-            if index not in ignore_rows:
-                yield line
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+
+    if "class" not in df.columns:
+        df = df.rename(columns={df.columns[4]: "class"})
+
+    if "block" in df.columns:
+        df["block"] = df["block"].astype(int)
+    else:
+        df["block"] = df.index // block_size  # i.e., incl. a (last) incomplete block
+
+    if "metadata" not in df.columns:
+        df["metadata"] = ""
+
+    # metadata are the dict of sampled.csv, as a string ... extract, rather than parse
+    df["decade"] = (
+        df["metadata"].str.extract(r'date within \\?"(\d{3})\d', expand=False) + "0"
+    )
+    df["spatial"] = df["metadata"].str.extract(
+        r"'spatial_distribution': '([^']*)'", expand=False
+    )
+    df[["decade", "spatial"]] = df[["decade", "spatial"]].fillna("")
+
+    return df
+
+
+def get_profile(df: pd.DataFrame) -> pd.DataFrame:
+    """Return the profile of blocks, as section, block, class, key, count rows, see get_blocks."""
+    sections = []
+
+    # class counts of each block, incl. zero counts
+    class_counts = (
+        df.groupby(["block", "class"]).size().unstack(fill_value=0).stack()
+    )
+    sections.append(to_section(class_counts, "class"))
+
+    # query word coverage of each class
+    query_counts = df.groupby(["class", "query"]).size()
+    sections.append(to_section(query_counts, "query", key="query"))
+
+    # extracts occurring more than once in all blocks, e.g., sampled by more than one stream,
+    # and the blocks they occur in
+    extracts = df[df["class"] != "c"].assign(extract_key=get_extract_keys)
+    duplicate_counts = extracts.groupby("extract_key").size()
+    duplicate_counts = duplicate_counts[duplicate_counts > 1]
+    sections.append(to_section(duplicate_counts, "duplicate", key="extract_key"))
+
+    duplicates = extracts.join(
+        duplicate_counts.rename("n"), on="extract_key", how="inner"
+    )
+    duplicate_block_counts = duplicates.groupby(["block", "extract_key"]).size()
+    sections.append(
+        to_section(duplicate_block_counts, "duplicate_block", key="extract_key")
+    )
+
+    # date and spatial distribution of each class in each block
+    for column in ["decade", "spatial"]:
+        counts = extracts.groupby(["block", "class", column]).size()
+        sections.append(to_section(counts, column, key=column))
+
+    return pd.concat(sections, ignore_index=True)[COLUMNS]
+
+
+def get_extract_keys(df: pd.DataFrame) -> pd.Series:
+    """Return the key of each extract of df, as url|query|digest, where digest is of the extract text (see make_blocks.get_key)."""
+    digests = df["extract"].map(
+        lambda extract: hashlib.sha1(extract.encode("utf-8")).hexdigest()[:10]
+    )
+    return df["url"] + "|" + df["query"] + "|" + digests
+
+
+def to_section(counts: pd.Series, section: str, *, key: str = None) -> pd.DataFrame:
+    """Return the section rows of counts, a series of group-by sizes indexed by (block,) (class,) (key)."""
+    df = counts.rename("count").reset_index()
+    df.insert(0, "section", section)
+    for column in ["block", "class"]:
+        if column not in df.columns:  # i.e., over all blocks, or classes
+            df[column] = ""
+    df["key"] = df[key] if key else ""
+
+    return df
 
 
 if __name__ == "__main__":
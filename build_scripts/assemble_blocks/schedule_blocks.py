@@ -0,0 +1,315 @@
+""" Schedule extracts into blocks, balancing query words and decades across blocks, see "python3 schedule_blocks.py -h"
+
+I.e., as make_blocks.py (same inputs and output), where, rather than filling
+each block in order from the pre-shuffled streams, the extracts of each class
+are assigned greedily, s.t., each block:
+
+    * has the class ratios (e.g., 20:20:5:5 positive:negative:additional:control)
+    * has at most -max_repeats extracts of any one query word (per class)
+    * has the decades (of the date range of the matching query) of each class
+      spread evenly, i.e., in proportion to the decades of all its extracts
+
+run
+```
+python3 schedule_blocks.py
+
+python3 schedule_blocks.py -n_blocks 200 -max_repeats 2 -seed 1
+```
+"""
+
+import argparse
+import ast
+import csv
+import heapq
+import os
+import random
+import re
+import typing
+from collections import Counter, defaultdict
+
+from make_blocks import (
+    CLASSES,
+    HEADER,
+    gen_csv_rows,
+    get_control,
+    get_counts,
+    get_key,
+    get_row,
+)
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""Schedule extracts into blocks, in the ratio positive:negative:additional:control,
+    with at most -max_repeats extracts of a query word per block, and decades spread evenly
+
+    Example:
+        python3 schedule_blocks.py -n_blocks 60 -block_size 50 -ratios 20 20 5 5 -max_repeats 3
+    """,
+)
+parser.add_argument(
+    "-n_blocks", nargs=1, type=int, default=[60], help="number of blocks"
+)
+parser.add_argument(
+    "-block_size", nargs=1, type=int, default=[50], help="number of extracts per block"
+)
+parser.add_argument(
+    "-ratios",
+    nargs=4,
+    type=int,
+    default=[20, 20, 5, 5],
+    metavar=("P", "N", "A", "C"),
+    help="ratio of positive:negative:additional:control extracts in each block",
+)
+parser.add_argument(
+    "-max_repeats",
+    nargs=1,
+    type=int,
+    default=[3],
+    help="maximum number of extracts of any one query word (of a class) in a block",
+)
+parser.add_argument(
+    "-seed",
+    nargs=1,
+    type=int,
+    help="seed of the tie breaks and the shuffle of each block, for reproducible blocks",
+)
+parser.add_argument(
+    "-positive",
+    nargs=1,
+    default=["../sample_2/contentious_words/sampled.csv"],
+    help="sampled.csv of positive (contentious) extracts",
+)
+parser.add_argument(
+    "-negative",
+    nargs=1,
+    default=["../sample_2/alternative_words/sampled.csv"],
+    help="sampled.csv of negative (alternative) extracts",
+)
+parser.add_argument(
+    "-additional",
+    nargs=1,
+    default=["../sample_2/additional_words/sampled.csv"],
+    help="sampled.csv of additional extracts",
+)
+parser.add_argument(
+    "-control", nargs=1, default=["control.csv"], help="csv of control extracts"
+)
+parser.add_argument(
+    "-huc",
+    nargs=1,
+    default=["huc_study.csv"],
+    help="csv of extracts used in a previous study",
+)
+parser.add_argument("-sav", nargs=1, default=["blocks.csv"], help="output csv")
+
+
+def main():
+
+    args = parser.parse_args()
+    rng = random.Random(args.seed[0] if args.seed else None)
+
+    block_size = args.block_size[0]
+    counts = dict(zip(CLASSES, get_counts(args.ratios, block_size)))
+    print(f"{block_size} extracts per block, i.e., {counts}")
+
+    # ------
+    # import the (unique) sampled extracts of each class
+    # ------
+    control = get_control(args.control[0], counts["c"])
+
+    # keys of extracts not to be (re)used, i.e., controls, those of a previous study, and those already imported
+    seen: typing.Set = {get_key(row) for row in control}
+    if os.path.exists(args.huc[0]):
+        seen.update(get_key(row) for row in gen_csv_rows(args.huc[0], ignore_rows=[0]))
+    else:
+        print(f"notice: {args.huc[0]} does not exist")
+
+    paths = {"p": args.positive[0], "n": args.negative[0], "a": args.additional[0]}
+    schedulers = {}
+    for row_class, path in paths.items():
+        rows = list(gen_unique(gen_csv_rows(path, ignore_rows=[0]), seen))
+        print(f"{len(rows)} {row_class} extracts")
+        schedulers[row_class] = Scheduler(
+            rows, max_repeats=args.max_repeats[0], rng=rng
+        )
+
+    # ------
+    # assign extracts to blocks, a block at a time
+    # ------
+    control_rows = [get_row(row, "c") for row in control]
+
+    with open(args.sav[0], "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+
+        n_blocks = 0
+        while n_blocks < args.n_blocks[0]:
+
+            block = get_block(schedulers, control_rows, counts=counts)
+            if block is None:
+                break
+
+            # randomly shuffle this
+            rng.shuffle(block)
+            writer.writerows(row + [n_blocks] for row in block)
+            n_blocks += 1
+
+    if n_blocks < args.n_blocks[0]:
+        print(f"notice: only {n_blocks} of {args.n_blocks[0]} blocks")
+
+
+def get_block(
+    schedulers: typing.Dict, control_rows: typing.List, *, counts: typing.Dict
+) -> typing.Union[typing.List, None]:
+    """Return the [idx, url, query, extract, class, metadata] rows of the next block, or None where not possible.
+
+    Args:
+        schedulers (dict): {class: Scheduler}, e.g., {"p": ..., "n": ..., "a": ...}
+        control_rows (list): control rows, i.e., added to every block
+        counts (dict): {class: number of rows per block}
+    """
+    block: typing.List = list(control_rows)
+    for row_class, scheduler in schedulers.items():
+        rows = scheduler.get_block(counts[row_class])
+        if rows is None:
+            print(f"notice: {row_class} extracts exhausted under the constraints")
+            return None
+        block += [get_row(row, row_class) for row in rows]
+
+    return block
+
+
+class Scheduler:
+    """Assign the extracts of a class to blocks, a block at a time.
+
+    Extracts are grouped by query word, and the words held in a priority queue
+    by their number of remaining extracts. For each slot of a block, the word
+    with the most remaining extracts (below -max_repeats in the block) is taken,
+    s.t., words are spread over as many blocks as possible, and, of that word,
+    the extract of the decade furthest behind its (even) share of all extracts
+    assigned so far.
+
+    Example:
+        scheduler = Scheduler(rows, max_repeats=3)
+        rows = scheduler.get_block(20)  # None, where the constraints cannot be met
+    """
+
+    def __init__(
+        self, rows: typing.List, *, max_repeats: int, rng: random.Random = random
+    ):
+        """
+        Args:
+            rows (list): [idx, url, query, extract, metadata] rows of sampled.csv
+            max_repeats (int): maximum number of rows of a query word per block
+            rng (random.Random): shuffles the rows of each (word, decade) and breaks ties between words
+        """
+        self.max_repeats = max_repeats
+
+        # {word: {decade: [rows]}}, and the share of each decade of all rows
+        self.rows = defaultdict(lambda: defaultdict(list))
+        self.shares = Counter()
+        for row in rows:
+            decade = get_decade(row)
+            self.rows[row[2]][decade].append(row)
+            self.shares[decade] += 1
+        for decades in self.rows.values():
+            for decade_rows in decades.values():
+                rng.shuffle(decade_rows)
+
+        # the number of rows assigned so far, in all and of each decade
+        self.n_rows = len(rows)
+        self.assigned = Counter()
+        self.n_assigned = 0
+
+        # priority queue of (-remaining rows, tie break, word)
+        self.queue = [
+            (-sum(len(r) for r in decades.values()), rng.random(), word)
+            for word, decades in self.rows.items()
+        ]
+        heapq.heapify(self.queue)
+
+    def get_block(self, n: int) -> typing.Union[typing.List, None]:
+        """Return n rows for the next block, or None (assigning none), where not possible.
+
+        I.e., where fewer than n rows remain within max_repeats per word.
+        """
+        if sum(min(-remaining, self.max_repeats) for remaining, _, _ in self.queue) < n:
+            return None
+
+        block = []
+        held = []  # words at max_repeats in this block, returned to the queue after
+        repeats = Counter()
+
+        while len(block) < n:
+            remaining, tie, word = heapq.heappop(self.queue)
+
+            block.append(self.pop_row(word))
+            repeats[word] += 1
+
+            if remaining + 1 < 0:
+                if repeats[word] < self.max_repeats:
+                    heapq.heappush(self.queue, (remaining + 1, tie, word))
+                else:
+                    held.append((remaining + 1, tie, word))
+
+        for item in held:
+            heapq.heappush(self.queue, item)
+
+        return block
+
+    def pop_row(self, word: str) -> typing.List:
+        """Remove and return a row of word, of the decade furthest behind its share."""
+        self.n_assigned += 1
+        decades = self.rows[word]
+        decade = max(
+            decades,
+            key=lambda d: self.n_assigned * self.shares[d] / self.n_rows
+            - self.assigned[d],
+        )
+        self.assigned[decade] += 1
+
+        row = decades[decade].pop()
+        if not decades[decade]:
+            del decades[decade]
+
+        return row
+
+
+def gen_unique(rows: typing.Iterable, seen: typing.Set) -> typing.Generator:
+    """Yield the rows whose keys (see make_blocks.get_key) are not in seen, adding their keys to seen."""
+    for row in rows:
+        key = get_key(row)
+        if key not in seen:
+            seen.add(key)
+            yield row
+
+
+def get_decade(row: typing.List) -> str:
+    """Return the decade of an [idx, url, query, extract, metadata] row, e.g., '1890', or '' where unknown.
+
+    I.e., the start of the date range of the (first) matching query, e.g.,
+    'kaukasisch AND date within "1890-01-01 1899-12-31" AND type=artikel', else
+    of the date of the article.
+    """
+    if len(row) < 5 or not row[4]:
+        return ""
+
+    # i.e., of the matching queries, w/o parsing the metadata
+    match = re.search(r'date within \\?"(\d{3})\d', row[4])
+    if match:
+        return match.group(1) + "0"
+
+    try:
+        metadata = ast.literal_eval(row[4])  # i.e., the dict of sampled.csv
+    except (ValueError, SyntaxError):
+        return ""
+
+    date = metadata.get("kb_oai_metadata", {}).get("date", "")
+    if re.match(r"\d{4}", date):
+        return date[:3] + "0"
+
+    return ""
+
+
+if __name__ == "__main__":
+    main()
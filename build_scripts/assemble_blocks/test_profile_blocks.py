@@ -0,0 +1,49 @@
+"""
+Check profile_blocks.py, against the committed blocks.csv (i.e., of the earlier make_blocks.py format) and its duplicate keys
+
+Run:
+    python3 -m pytest test_profile_blocks.py
+"""
+import os
+
+import pandas as pd
+
+import profile_blocks
+
+BLOCKS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blocks.csv")
+
+
+def test_committed_blocks():
+
+    # header ,url,query,extract, i.e., class unnamed, by position, and no block column
+    df = profile_blocks.get_blocks(BLOCKS_CSV)
+    assert list(df["class"]) == ["n"]
+    assert list(df["block"]) == [0]
+
+    profile = profile_blocks.get_profile(df)
+    assert list(profile.columns) == profile_blocks.COLUMNS
+
+    class_counts = profile[profile["section"] == "class"]
+    assert class_counts[["block", "class", "count"]].values.tolist() == [[0, "n", 1]]
+    assert not (profile["section"] == "duplicate").any()
+
+
+def test_duplicate_keys():
+
+    # two distinct extracts of the same url, each occurring twice (in blocks 0 and 1)
+    rows = [["0", "u", "q", "e1", "p"], ["1", "u", "q", "e2", "n"]] * 2
+    df = pd.DataFrame(rows, columns=["", "url", "query", "extract", "class"])
+    df["block"] = [0, 0, 1, 1]
+    for column in ["decade", "spatial"]:
+        df[column] = ""
+
+    profile = profile_blocks.get_profile(df)
+
+    duplicates = profile[profile["section"] == "duplicate"]
+    assert duplicates["key"].nunique() == 2
+    assert list(duplicates["count"]) == [2, 2]
+    assert all(key.startswith("u|q|") for key in duplicates["key"])
+
+    duplicate_blocks = profile[profile["section"] == "duplicate_block"]
+    assert len(duplicate_blocks) == 4
+    assert not duplicate_blocks.duplicated(["block", "key"]).any()
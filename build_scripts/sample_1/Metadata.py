@@ -1,223 +1,710 @@
+import datetime
+import functools
 import itertools
 import json
 import os
 import random
 import re
+import sqlite3
+import threading
 import time
 import typing
+import urllib.parse
 from collections import defaultdict
-from multiprocessing.pool import ThreadPool
+from xml.parsers.expat import ExpatError
 
-import requests
 import xmltodict
 
+from harvest import gen_fetched
+from kb_client import get_response
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    id INTEGER PRIMARY KEY,
+    url TEXT UNIQUE NOT NULL,
+    europeana_issue_id TEXT,
+    kb_issue_id TEXT,
+    oai_issue_id TEXT,
+    kb_oai_metadata_queried INTEGER NOT NULL DEFAULT 0,
+    kb_oai_metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS queries (
+    id INTEGER PRIMARY KEY,
+    query TEXT UNIQUE NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS article_queries (
+    article_id INTEGER NOT NULL REFERENCES articles (id),
+    query_id INTEGER NOT NULL REFERENCES queries (id),
+    UNIQUE (query_id, article_id)
+);
+CREATE TABLE IF NOT EXISTS issue_metadata (
+    oai_issue_id TEXT PRIMARY KEY,
+    kb_oai_metadata TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS catalogue_revision (
+    revision REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS articles_kb_issue_id ON articles (kb_issue_id);
+CREATE INDEX IF NOT EXISTS articles_europeana_issue_id ON articles (europeana_issue_id);
+CREATE INDEX IF NOT EXISTS article_queries_article_id ON article_queries (article_id);
+"""
+MMAP_SIZE = 2 * 1024**3  # bytes of metadata.db read via a memory map
+AUTOCHECKPOINT_PAGES = 10000  # pages in metadata.db-wal before it is merged into metadata.db
+OAI_URL = "http://services.kb.nl/mdo/oai/e3c39382-fe3c-421f-bda7-6feb59d11211/"
+
+
+class OAIError(Exception):
+    """Raised where an oai ListRecords page cannot be harvested (after retries)."""
+
 
 class Metadata(object):
     """Create an object for assembly/ storage of KB/ europeana newspaper article metadata.
 
-    Loads self.metadata and self.queries from metadata.json (if available).
-    otherwise creates new.
+    Opens the article records and queries of metadata.db (if available),
+    otherwise creates new, importing metadata.json (if available) from the same
+    dir. Records are persisted as they are added: metadata.db is an SQLite file
+    in write-ahead-log mode, s.t., each commit only appends the changed pages
+    to metadata.db-wal, which is periodically merged into metadata.db (see
+    compact). Records are paged in (memory-mapped) as they are read, i.e.,
+    opening metadata.db costs the same regardless of its size.
+
+    Passing a .json metadata_file instead, records are loaded from it into
+    memory, and only saved via to_json.
+
+    Where a catalogue_file (see catalogue_index.py) is passed, it is attached
+    to the store, s.t., europeana ids are looked up as urls are added (and
+    re-attached to existing records whenever the catalogue changed, or
+    records were added without one).
 
     Args:
-        metadata_file (str): filepath to metadata.json [default:'metadata.json']
+        metadata_file (str): filepath to metadata.db or metadata.json [default:'metadata.db']
+        catalogue_file (str): filepath to europeana_catalogue.db [default: None]
     """
 
-    def __init__(self, metadata_file: str = "metadata.json"):
+    def __init__(
+        self, metadata_file: str = "metadata.db", *, catalogue_file: str = None
+    ):
         """
         Properties:
 
-            self.metadata['http://resolver.kb.nl/resolve?urn=ddd:010567709:mpeg21:a0493:ocr'] = {
-                    "europeana_issue_id": "/9200359/BibliographicResource_3000116007227"
-                    "kb_issue_id": 'ddd:010567709:mpeg21'  # referenced in europeana metadata
-                    "oai_issue_id": 'DDD:ddd:010567709:mpeg21',
-                    "matching_queries": ['berber'],
-                    "kb_oai_metadata_queried": False
-                    "kb_oai_metadata": {
-                        "title": # from kb.nl/mdo/oai,
-                        "date": # from kb.nl/mdo/oai ,
-                        "temporal": # from kb.nl/mdo/oai,
-                        "publisher": # from kb.nl/mdo/oai,
-                        "spatial_distribution": # from kb.nl/mdo/oai,
-                        "spatial_origin": # from kb.nl/mdo/oai,
-                        "language": [] # from kb.nl/mdo/oai,
-                        "datestamp: # from kb.nl/mdo/oai,
-                    }
+            self.db: an SQLite store of the article records, with tables:
+
+                articles: a record per kb article (ocr url), e.g.,
+                    url: 'http://resolver.kb.nl/resolve?urn=ddd:010567709:mpeg21:a0493:ocr'
+                    europeana_issue_id: "/9200359/BibliographicResource_3000116007227"
+                    kb_issue_id: 'ddd:010567709:mpeg21'  # referenced in europeana metadata
+                    oai_issue_id: 'DDD:ddd:010567709:mpeg21',
+                    kb_oai_metadata_queried: 0
+                    kb_oai_metadata: '{"title": ..., "date": ..., ...}'  # json, from kb.nl/mdo/oai
+
+                queries: every query passed to add_urls, e.g., 'berber', and
+                    whether all of its matching urls have been added
+
+                article_queries: (article, query) pairs, i.e., the
+                    "matching_queries" of each article
+
+                issue_metadata: kb_oai_metadata by oai_issue_id, as harvested
+                    in bulk (see harvest_issue_metadata) or requested per issue
+
+                catalogue_revision: the revision of europeana_catalogue.db
+                    whose europeana ids were last attached to all records
+                    (none, where records were since added w/o a catalogue)
+
+            self.queries = set(['blank', 'berber', ...])  # completed queries only
+
+            self.catalogue: whether europeana_catalogue.db is attached, as
+                "catalogue", i.e., table catalogue.catalogue (kb_issue_id, europeana_issue_id)
+
+        Records are exported (see to_json, get_record) in the form:
+
+            {
+                "europeana_issue_id": "/9200359/BibliographicResource_3000116007227"
+                "kb_issue_id": 'ddd:010567709:mpeg21'
+                "oai_issue_id": 'DDD:ddd:010567709:mpeg21',
+                "matching_queries": ['berber'],
+                "kb_oai_metadata_queried": False
+                "kb_oai_metadata": {
+                    "title": # from kb.nl/mdo/oai,
+                    "date": # from kb.nl/mdo/oai ,
+                    "temporal": # from kb.nl/mdo/oai,
+                    "publisher": # from kb.nl/mdo/oai,
+                    "spatial_distribution": # from kb.nl/mdo/oai,
+                    "spatial_origin": # from kb.nl/mdo/oai,
+                    "language": [] # from kb.nl/mdo/oai,
+                    "datestamp: # from kb.nl/mdo/oai,
                 }
-            self.queries = set(['blank', 'berber', ...])
+            }
         """
-        self.metadata: typing.Dict = {}
-        self.queries = set([])
-        if metadata_file:
-            if os.path.exists(metadata_file):
-                print("import metadata.json")
-                self.metadata: typing.Dict = get_json(metadata_file)
-                self.queries = set(self.metadata.pop("queries"))
+        self.lock = threading.Lock()  # serialises access to self.db across threads
+
+        if metadata_file and not metadata_file.endswith(".json"):
+            json_file = os.path.splitext(metadata_file)[0] + ".json"
+            new = not os.path.exists(metadata_file)
+
+            self.db = sqlite3.connect(metadata_file, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self.db.execute(f"PRAGMA wal_autocheckpoint={AUTOCHECKPOINT_PAGES}")
+            self.db.executescript(SCHEMA)
+
+            if new and os.path.exists(json_file):
+                print(f"import {json_file} into {metadata_file}")
+                self.from_json(json_file)
+
+        else:
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+            self.db.executescript(SCHEMA)
+
+            if metadata_file:
+                if os.path.exists(metadata_file):
+                    print("import metadata.json")
+                    self.from_json(metadata_file)
+
+        self.catalogue = bool(catalogue_file)
+        if self.catalogue:
+            self.db.execute("ATTACH DATABASE ? AS catalogue", (catalogue_file,))
+
+            # where the catalogue changed since last attached (or records were added
+            # w/o it, see add_urls), update existing records
+            (revision,) = self.db.execute(
+                "SELECT MAX(revision) FROM catalogue.revision"
+            ).fetchone()
+            applied = self.db.execute(
+                "SELECT revision FROM catalogue_revision"
+            ).fetchone()
+            if applied is None or applied[0] != revision:
+                print(f"attach europeana ids of {catalogue_file}")
+                self.add_europeana_ids()
+
+    @property
+    def queries(self) -> typing.Set[str]:
+        with self.lock:
+            return set(
+                q for (q,) in self.db.execute("SELECT query FROM queries WHERE complete")
+            )
 
     def add_urls(self, ocr_urls: typing.Iterable, query: str):
-        """Update self.metadata with new kb article entries (key=kb ocr url) and/or update to record matching query
+        """Add new kb article records (key=kb ocr url) and/or update to record matching query
 
         Args:
             ocr_urls (Iterable): http://resolver.kb.nl/resolve?urn=ABCDDD:010842133:mpeg21:a0368:ocr
             query (str): the query which ocr_urls matches against
         """
-
-        for ocr_url in ocr_urls:
-
-            # create new record for unseen urls
-            if ocr_url not in self.metadata.keys():
-                self.metadata[ocr_url] = {
-                    "europeana_issue_id": None,
-                    "kb_issue_id": re.search(".+=(.+):a.+:ocr", ocr_url).group(1),
-                    "oai_issue_id": get_oai_issue_id(
-                        ocr_url
-                    ),  # returns None if not 'ddd' (europeana included set)
-                    "matching_queries": [],
-                    "kb_oai_metadata_queried": False,
-                    "kb_oai_metadata": {},
-                }
-
-            # attribute matching query for new and old records (if query unseen)
-            if query not in self.metadata[ocr_url]["matching_queries"]:
-                self.metadata[ocr_url]["matching_queries"].append(query)
+        with self.lock:
+            query_id = self.get_query_id(query)
+            self.db.commit()
+
+        # create new records with the europeana id of their issue, where in the catalogue
+        if self.catalogue:
+            insert = """INSERT OR IGNORE INTO articles (url, kb_issue_id, oai_issue_id, europeana_issue_id)
+                VALUES (?1, ?2, ?3, (SELECT europeana_issue_id FROM catalogue.catalogue WHERE kb_issue_id = ?2))"""
+        else:
+            insert = "INSERT OR IGNORE INTO articles (url, kb_issue_id, oai_issue_id) VALUES (?, ?, ?)"
+
+        # insert in batches, s.t., ocr_urls is consumed lazily
+        ocr_urls = iter(ocr_urls)
+        while True:
+            batch = list(itertools.islice(ocr_urls, 10000))
+            if not batch:
+                break
+
+            with self.lock:
+                # create new record for unseen urls
+                self.db.executemany(
+                    insert,
+                    (
+                        (
+                            ocr_url,
+                            re.search(".+=(.+):a.+:ocr", ocr_url).group(1),
+                            get_oai_issue_id(
+                                ocr_url
+                            ),  # returns None if not 'ddd' (europeana included set)
+                        )
+                        for ocr_url in batch
+                    ),
+                )
+
+                # attribute matching query for new and old records (if query unseen)
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO article_queries (article_id, query_id) "
+                    + "SELECT id, ? FROM articles WHERE url = ?",
+                    ((query_id, ocr_url) for ocr_url in batch),
+                )
+                self.db.commit()
 
         # add query to self.queries set
-        self.queries.add(query)
-
-    def add_europeana_ids(self, europeana_catalogue: typing.Iterable):
-        """For each url/record in self.metadata attach correct europeana id.
+        with self.lock:
+            self.db.execute("UPDATE queries SET complete = 1 WHERE id = ?", (query_id,))
+            if not self.catalogue:
+                # i.e., records w/o europeana ids, attached when next opened with a catalogue
+                self.db.execute("DELETE FROM catalogue_revision")
+            self.db.commit()
+
+    def add_europeana_ids(self, europeana_catalogue: typing.Iterable = None):
+        """For each url/record attach correct europeana id.
+
+        Without europeana_catalogue, records are looked up in the attached
+        catalogue, and their ids updated where missing or changed (e.g., via
+        catalogue.py -update), and its revision recorded (done on opening the
+        store, where the catalogue changed since). Records added via add_urls
+        already have the id attached.
 
         Args:
-            europeana_catalogue (iterable):
+            europeana_catalogue (iterable): (eu_id, isShownAt) rows of europeana_catalogue.csv
         """
+        if europeana_catalogue is None:
+            with self.lock:
+                self.db.execute(
+                    """UPDATE articles SET europeana_issue_id = (
+                        SELECT c.europeana_issue_id FROM catalogue.catalogue c
+                        WHERE c.kb_issue_id = articles.kb_issue_id
+                    )
+                    WHERE kb_issue_id IN (SELECT kb_issue_id FROM catalogue.catalogue)
+                    AND europeana_issue_id IS NOT (
+                        SELECT c.europeana_issue_id FROM catalogue.catalogue c
+                        WHERE c.kb_issue_id = articles.kb_issue_id
+                    )"""
+                )
+                self.db.execute("DELETE FROM catalogue_revision")
+                self.db.execute(
+                    "INSERT INTO catalogue_revision (revision) "
+                    + "SELECT MAX(revision) FROM catalogue.revision"
+                )
+                self.db.commit()
+            return
+
+        with self.lock:
+            self.db.executemany(
+                "UPDATE articles SET europeana_issue_id = ? WHERE kb_issue_id = ?",
+                (
+                    (eu_id, re.search(".+=(.+)", isShownAt).group(1))
+                    for eu_id, isShownAt in europeana_catalogue
+                ),
+            )
+            self.db.commit()
 
-        hash = defaultdict(list)  # parent newspaper id: [article_id, article2_id, ...]
-        for url, data in self.metadata.items():
-            hash[data["kb_issue_id"]].append(url)
-
-        for eu_id, isShownAt in europeana_catalogue:
-            kb_id: str = re.search(".+=(.+)", isShownAt).group(1)
-
-            if kb_id in hash.keys():
-                for url in hash[kb_id]:
-                    self.metadata[url]["europeana_issue_id"] = eu_id
-
-    def add_metadata(self, queries, n):
+    def add_metadata(self, queries, n, *, max_in_flight: int = 50, seed: int = None):
         """Add metadata for n random articles matching a query (previously unqueried, with europeana_issue_id)
 
         Note: only those urls previously unqueried form oai metadata, part of
         europeana form part of the pool for random selection.
-        """
 
-        url_selection: typing.Generator = self.get_url_random_selection(queries, n)
+        Note: oai metadata is that of the issue, i.e., the oai record of each
+        issue is requested once, and added to all selected articles of the issue.
+
+        Args:
+            queries (iterable):
+            n (int): number of urls per query to retrieve
+            max_in_flight (int): number of concurrent oai requests
+            seed (int): seed of the random selection, see get_url_random_selection
+        """
 
-        # in parallel, get oai record for url, and update self.metadata
-        with ThreadPool(50) as p:
-            p.map(self.add_metadata_map, url_selection)
+        url_selection: typing.List = list(
+            self.get_url_random_selection(queries, n, seed=seed)
+        )
+
+        # group the selected urls by issue
+        issues = defaultdict(set)  # {oai_issue_id: set of urls}
+        with self.lock:
+            for url in url_selection:
+                (oai_issue_id,) = self.db.execute(
+                    "SELECT oai_issue_id FROM articles WHERE url = ?", (url,)
+                ).fetchone()
+                issues[oai_issue_id].add(url)
+
+        # look up issues in issue_metadata, e.g., as harvested via harvest_issue_metadata
+        local = {}  # {oai_issue_id: kb_oai_metadata}
+        for oai_issue_id in issues:
+            kb_oai_metadata = self.get_issue_metadata(oai_issue_id)
+            if kb_oai_metadata:
+                local[oai_issue_id] = kb_oai_metadata
+
+        # in parallel, get oai metadata for each remaining issue
+        fetched: typing.Generator = gen_fetched(
+            (oai_issue_id for oai_issue_id in issues if oai_issue_id not in local),
+            f=get_oai_metadata,
+            max_in_flight=max_in_flight,
+        )
+
+        # update self.db for the urls of each issue
+        for oai_issue_id, kb_oai_metadata in itertools.chain(local.items(), fetched):
+            if kb_oai_metadata:
+                if oai_issue_id not in local:
+                    self.add_issue_metadata([(oai_issue_id, kb_oai_metadata)])
+
+                with self.lock:
+                    self.db.executemany(
+                        "UPDATE articles SET kb_oai_metadata_queried = 1, kb_oai_metadata = ? WHERE url = ?",
+                        (
+                            (json.dumps(kb_oai_metadata), url)
+                            for url in issues[oai_issue_id]
+                        ),
+                    )
+                    self.db.commit()
 
     def get_url_random_selection(
-        self, queries: typing.Iterable, n: int
+        self, queries: typing.Iterable, n: int, *, seed: int = None
     ) -> typing.Generator:
         """Return a RANDOM sample generator of 'n' urls w/o metadata, wrt., each query.
 
         Note: only those urls previously unqueried form oai metadata, part of
         europeana form part of the pool for random selection.
 
+        Each query is sampled w/o replacement (reservoir sampling, i.e., every
+        potential url is equally likely to be selected), in a single pass over
+        its potential urls, s.t., only n urls per query are held at a time.
+
         Args:
             queries (iterable):
             n (int): number of urls per query to retrieve
+            seed (int): seed of the random selection, for a reproducible sample (given the same urls) [default: None]
         """
-        queries_set = set(queries)
+        rng = random.Random(seed)
 
         # ------
-        # assemble a dict of {query:list of potential urls, ...}, wrt., passed queries
+        # assemble a dict of {query: reservoir of n urls, ...}, wrt., passed queries
         #   - potentials are previously unqueried (for metadata) and have a europeana id.
         # -----
-        potential = defaultdict(list)
-        for url in self.metadata.keys():
-
-            incommon_queries = queries_set.intersection(
-                set(self.metadata[url]["matching_queries"])
-            )
-            if (
-                self.metadata[url]["kb_oai_metadata_queried"] is False
-                and self.metadata[url]["europeana_issue_id"] is not None
-                # and self.metadata[url]["oai_issue_id"] is not None  # already implied by above condition, since when oai_issue_id = None, i.e, not a ddd item, them not present in europeana
-                and bool(incommon_queries)
-            ):
-                for q in incommon_queries:
-                    potential[q].append(url)
+        reservoirs = {}
+        with self.lock:
+            for query in queries:
+                if query in reservoirs:
+                    continue
+
+                rows = self.db.execute(
+                    """SELECT a.url FROM article_queries aq
+                    JOIN queries q ON q.id = aq.query_id
+                    JOIN articles a ON a.id = aq.article_id
+                    WHERE q.query = ?
+                    AND a.kb_oai_metadata_queried = 0
+                    AND a.europeana_issue_id IS NOT NULL
+                    ORDER BY a.url""",
+                    (query,),
+                )  # ordered, since the reservoir depends on the order of rows
+                reservoirs[query] = get_reservoir((url for (url,) in rows), n, rng)
 
         # ------
-        # for each query, randomnly sample w/o replacement and yield
+        # for each query, yield its sample
         # ------
-        for query in queries:
-            for url in random.sample(potential[query], k=min(n, len(potential[query]))):
+        for reservoir in reservoirs.values():
+            for url in reservoir:
                 yield url
 
-    def add_metadata_map(self, url):
-
-        url, record = get_oai_record(url, self.metadata[url]["oai_issue_id"])
-
-        if record:
-            self.metadata[url]["kb_oai_metadata_queried"] = True
-            self.metadata[url]["kb_oai_metadata"]["datestamp"] = record["header"][
-                "datestamp"
-            ]
-
-            m = record["metadata"]["didl:DIDL"]["didl:Item"]["didl:Component"][0][
-                "didl:Resource"
-            ]["srw_dc:dcx"]
-
-            self.metadata[url]["kb_oai_metadata"]["title"] = m["dc:title"]
-            self.metadata[url]["kb_oai_metadata"]["date"] = m["dc:date"]
-            self.metadata[url]["kb_oai_metadata"]["temporal"] = m["dcterms:temporal"]
-            self.metadata[url]["kb_oai_metadata"]["publisher"] = m["dc:publisher"]
-            self.metadata[url]["kb_oai_metadata"]["spatial_distribution"] = m[
-                "dcterms:spatial"
-            ][0]
-            self.metadata[url]["kb_oai_metadata"]["spatial_origin"] = m[
-                "dcterms:spatial"
-            ][1]["#text"]
-
-            # language edge cases
-            self.metadata[url]["kb_oai_metadata"]["language"] = []
-            entry = m["dc:language"]
-            if type(entry) == list:
-                for i in entry:
-                    self.metadata[url]["kb_oai_metadata"]["language"].append(i["#text"])
-            else:
-                self.metadata[url]["kb_oai_metadata"]["language"].append(entry["#text"])
+    def harvest_issue_metadata(
+        self,
+        date_ranges: typing.Iterable,
+        *,
+        set_spec: str = None,
+        max_in_flight: int = 4,
+    ) -> int:
+        """Harvest the oai metadata of all issues in date_ranges to issue_metadata, in bulk.
+
+        I.e., via oai ListRecords pages (following resumption tokens), rather
+        than a GetRecord request per issue. Date ranges are harvested
+        concurrently, their pages in sequence. Return the number of issues harvested.
+
+        Raises OAIError (once all date ranges are tried) listing the date
+        ranges not harvested in full, e.g., to be re-harvested, incl. those of
+        which no record could be parsed. Deleted records are skipped, other
+        records that cannot be parsed are counted and reported.
+
+        Note: oai from/until select records by datestamp (i.e., the date the
+        record was last modified in the kb oai repository), not by the date
+        of the issue.
+
+        Args:
+            date_ranges (iterable): (from, until) pairs of YYYY-MM-DD (or None), see gen_date_ranges
+            set_spec (str): oai set to harvest [default: None, i.e., all]
+            max_in_flight (int): number of date ranges harvested concurrently
+        """
+        harvest_range = functools.partial(self.harvest_range, set_spec=set_spec)
+
+        harvested = 0
+        unparsed = 0
+        failed = []  # date ranges not harvested in full
+        for (from_date, until_date), (n, n_unparsed, error) in gen_fetched(
+            date_ranges,
+            f=harvest_range,
+            max_in_flight=max_in_flight,
+            key=lambda date_range: "services.kb.nl",
+        ):
+            print(f"\t{n} issues harvested from {from_date} until {until_date}")
+            harvested += n
+            unparsed += n_unparsed
+            if n_unparsed:
+                print(f"\tnotice: {n_unparsed} records not parsed from {from_date} until {until_date}")
+                if not n and not error:  # i.e., none parsed, e.g., a change of the oai schema
+                    error = OAIError(f"none of {n_unparsed} records parsed")
+            if error:
+                print(f"\tincomplete harvest from {from_date} until {until_date}: {error}")
+                failed.append((from_date, until_date))
+
+        if unparsed:
+            print(f"notice: {unparsed} records not parsed, of {harvested + unparsed} (not deleted) records")
+        if failed:
+            raise OAIError(f"{len(failed)} date ranges not harvested in full: {failed}")
+
+        return harvested
+
+    def harvest_range(
+        self, date_range: typing.Tuple, *, set_spec: str = None
+    ) -> typing.Tuple[int, int, typing.Union[OAIError, None]]:
+        """Harvest the oai metadata of the issues of a (from, until) date range, page by page.
+
+        Return (number of issues harvested, number of records not parsed, None
+        or the OAIError where not harvested in full). Deleted records (i.e.,
+        header status "deleted") are skipped, and not counted.
+        """
+        from_date, until_date = date_range
+
+        n = 0
+        n_unparsed = 0
+        try:
+            for records in gen_oai_pages(from_date, until_date, set_spec=set_spec):
+                issue_metadata = []
+                for record in records:
+                    try:
+                        if record["header"].get("@status") == "deleted":
+                            continue
+                        issue_metadata.append(
+                            (record["header"]["identifier"], parse_oai_record(record))
+                        )
+                    except (KeyError, IndexError, TypeError, AttributeError):
+                        n_unparsed += 1  # e.g., other than issue records, or a changed schema
+
+                self.add_issue_metadata(issue_metadata)
+                n += len(issue_metadata)
+        except OAIError as e:
+            return n, n_unparsed, e
+
+        return n, n_unparsed, None
+
+    def add_issue_metadata(self, issue_metadata: typing.Iterable) -> typing.NoReturn:
+        """Add (oai_issue_id, kb_oai_metadata) pairs to issue_metadata."""
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO issue_metadata (oai_issue_id, kb_oai_metadata) VALUES (?, ?)",
+                (
+                    (oai_issue_id, json.dumps(kb_oai_metadata))
+                    for oai_issue_id, kb_oai_metadata in issue_metadata
+                ),
+            )
+            self.db.commit()
+
+    def get_issue_metadata(self, oai_issue_id: str) -> typing.Union[typing.Dict, None]:
+        """Return the kb_oai_metadata of an issue from issue_metadata, or None if absent."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT kb_oai_metadata FROM issue_metadata WHERE oai_issue_id = ?",
+                (oai_issue_id,),
+            ).fetchone()
+
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def get_record(self, url: str) -> typing.Union[typing.Dict, None]:
+        """Return the record of an article url (as in metadata.json), or None if absent."""
+        with self.lock:
+            rows = self.db.execute(
+                RECORDS_SELECT + " WHERE a.url = ? ORDER BY aq.rowid", (url,)
+            ).fetchall()
+
+        if rows:
+            return to_record(rows)
+        return None
+
+    def gen_records(
+        self, *, queried_only: bool = False, batch_size: int = 10000
+    ) -> typing.Generator:
+        """Yield (url, record) for every article, where record is as in metadata.json.
+
+        Records are read in batches of batch_size articles, each with self.lock
+        held, and yielded with it released, s.t., the store can be used (e.g.,
+        get_record, add_metadata) while iterating.
+
+        Args:
+            queried_only (bool): only articles for which oai metadata was retrieved
+            batch_size (int): number of articles read at a time
+        """
+        where = " AND kb_oai_metadata_queried = 1" if queried_only else ""
+        where_a = " AND a.kb_oai_metadata_queried = 1" if queried_only else ""
+
+        last_id = 0
+        while True:
+            with self.lock:
+                ids = self.db.execute(
+                    "SELECT id FROM articles WHERE id > ?" + where + " ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+                if not ids:
+                    return
+
+                rows = self.db.execute(
+                    RECORDS_SELECT
+                    + " WHERE a.id BETWEEN ? AND ?"
+                    + where_a
+                    + " ORDER BY a.id, aq.rowid",
+                    (ids[0][0], ids[-1][0]),
+                ).fetchall()
+            last_id = ids[-1][0]
+
+            for url, url_rows in itertools.groupby(rows, key=lambda row: row[0]):
+                yield url, to_record(list(url_rows))
+
+    def from_json(self, metadata_file: str) -> typing.NoReturn:
+        """Import the records and queries of a metadata.json file."""
+        metadata: typing.Dict = get_json(metadata_file)
+
+        with self.lock:
+            for query in metadata.pop("queries"):
+                self.db.execute(
+                    "UPDATE queries SET complete = 1 WHERE id = ?",
+                    (self.get_query_id(query),),
+                )
+
+            for url, data in metadata.items():
+                article_id = self.db.execute(
+                    """INSERT INTO articles (url, europeana_issue_id, kb_issue_id, oai_issue_id,
+                    kb_oai_metadata_queried, kb_oai_metadata) VALUES (?, ?, ?, ?, ?, ?)""",
+                    (
+                        url,
+                        data["europeana_issue_id"],
+                        data["kb_issue_id"],
+                        data["oai_issue_id"],
+                        int(data["kb_oai_metadata_queried"]),
+                        json.dumps(data["kb_oai_metadata"]),
+                    ),
+                ).lastrowid
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO article_queries (article_id, query_id) VALUES (?, ?)",
+                    ((article_id, self.get_query_id(q)) for q in data["matching_queries"]),
+                )
+
+            self.db.commit()
+
+    def compact(self) -> typing.NoReturn:
+        """Merge the write-ahead log into metadata.db and truncate the log.
+
+        Note: also done automatically every AUTOCHECKPOINT_PAGES changed pages.
+        """
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
     def to_json(self, save_file: str = "metadata.json") -> typing.NoReturn:
 
-        # incorporate queries into self.metadata for saving
-        self.metadata["queries"] = list(self.queries)  # save queries
+        # incorporate queries into the records for saving
+        metadata = dict(self.gen_records())
+        metadata["queries"] = list(self.queries)  # save queries
 
         print("saving metadata update to metadata.json")
-        to_json(self.metadata, save_file)
+        to_json(metadata, save_file)
         print('\nsee "metadata.json" for updates to queried metadata')
 
     def get_europeana_match_count(self, query: str) -> int:
 
-        count = 0
-        for article_url, data in self.metadata.items():
-            if (
-                query in data["matching_queries"]
-                and data["europeana_issue_id"] is not None
-            ):
-                count += 1
+        with self.lock:
+            (count,) = self.db.execute(
+                """SELECT COUNT(*) FROM article_queries aq
+                JOIN queries q ON q.id = aq.query_id
+                JOIN articles a ON a.id = aq.article_id
+                WHERE q.query = ? AND a.europeana_issue_id IS NOT NULL""",
+                (query,),
+            ).fetchone()
 
         return count
 
     def get_kb_match_count(self, query: str) -> int:
 
-        count = 0
-        for article_url, data in self.metadata.items():
-            if query in data["matching_queries"]:
-                count += 1
+        with self.lock:
+            (count,) = self.db.execute(
+                """SELECT COUNT(*) FROM article_queries aq
+                JOIN queries q ON q.id = aq.query_id
+                WHERE q.query = ?""",
+                (query,),
+            ).fetchone()
 
         return count
 
+    def get_match_counts(
+        self, queries: typing.Iterable
+    ) -> typing.Dict[str, typing.Tuple[int, int]]:
+        """Return {query: (kb match count, europeana match count)} for all queries at once.
+
+        I.e., get_kb_match_count and get_europeana_match_count of every query,
+        counted in a single pass over the article_queries table.
+
+        Args:
+            queries (iterable): queries to count (queries not in the store count 0)
+        """
+        counts = {query: (0, 0) for query in queries}
+
+        with self.lock:
+            rows = self.db.execute(
+                """SELECT q.query, COUNT(*), COUNT(a.europeana_issue_id)
+                FROM article_queries aq
+                JOIN queries q ON q.id = aq.query_id
+                JOIN articles a ON a.id = aq.article_id
+                GROUP BY aq.query_id"""
+            )
+            for query, kb_count, eu_count in rows:
+                if query in counts:
+                    counts[query] = (kb_count, eu_count)
+
+        return counts
+
+    def get_query_id(self, query: str) -> int:
+        """Return the id of query, adding it to the queries table if new. Call with self.lock held."""
+        self.db.execute("INSERT OR IGNORE INTO queries (query) VALUES (?)", (query,))
+        (query_id,) = self.db.execute(
+            "SELECT id FROM queries WHERE query = ?", (query,)
+        ).fetchone()
+
+        return query_id
+
+
+RECORDS_SELECT = """SELECT a.url, a.europeana_issue_id, a.kb_issue_id, a.oai_issue_id,
+    a.kb_oai_metadata_queried, a.kb_oai_metadata, q.query
+    FROM articles a
+    LEFT JOIN article_queries aq ON aq.article_id = a.id
+    LEFT JOIN queries q ON q.id = aq.query_id"""
+
+
+def to_record(rows: typing.List) -> typing.Dict:
+    """Return a metadata.json record from the RECORDS_SELECT rows of a single article."""
+    url, eu_id, kb_issue_id, oai_issue_id, queried, kb_oai_metadata, _ = rows[0]
+
+    return {
+        "europeana_issue_id": eu_id,
+        "kb_issue_id": kb_issue_id,
+        "oai_issue_id": oai_issue_id,
+        "matching_queries": [row[-1] for row in rows if row[-1] is not None],
+        "kb_oai_metadata_queried": bool(queried),
+        "kb_oai_metadata": json.loads(kb_oai_metadata),
+    }
+
+
+def get_reservoir(
+    iterable: typing.Iterable, n: int, rng: random.Random
+) -> typing.List:
+    """Return a random sample of n items of iterable, w/o replacement, in a single pass.
+
+    I.e., reservoir sampling (Algorithm R): the i-th item replaces a random
+    item of the sample with probability n/i.
+    """
+    reservoir = []
+    for i, item in enumerate(iterable):
+        if i < n:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(i + 1)
+            if j < n:
+                reservoir[j] = item
+
+    return reservoir
+
 
 def get_oai_issue_id(article_url) -> typing.Union[str, None]:
     """Return the kb oai_issue_id  of any 'ddd' subset newspaper issue (only ddd is in europeana)."""
@@ -237,7 +724,7 @@ def get_oai_record(url: str, oai_issue_id: str) -> dict:
     Note: if no record, returns [url, None]
     """
 
-    base_url = "http://services.kb.nl/mdo/oai/e3c39382-fe3c-421f-bda7-6feb59d11211/?verb=GetRecord&metadataPrefix=didl"
+    base_url = OAI_URL + "?verb=GetRecord&metadataPrefix=didl"
 
     # get the record from kb oai api
     response = get_response(base_url + "&identifier=" + oai_issue_id)
@@ -249,48 +736,146 @@ def get_oai_record(url: str, oai_issue_id: str) -> dict:
         return [url, None]
 
 
-def to_json(container, filename: str) -> typing.NoReturn:
-    with open(filename, "w") as f:
-        json.dump(container, f, indent=4)
+def get_oai_metadata(oai_issue_id: str) -> typing.Union[typing.Dict, None]:
+    """Return the kb_oai_metadata of an issue, or None if no record."""
+    url, record = get_oai_record(None, oai_issue_id)
 
+    if record:
+        return parse_oai_record(record)
+    return None
 
-def get_json(filename: str):
-    with open(filename, "r") as f:
-        return json.load(f)
 
+def gen_oai_pages(
+    from_date: str = None,
+    until_date: str = None,
+    *,
+    set_spec: str = None,
+    max_attempts: int = 5,
+) -> typing.Generator:
+    """Yield the list of (xmltodict parsed) records of each oai ListRecords page.
 
-def get_response(
-    url: str, *, max_attempts=5, **request_kwargs
-) -> typing.Union[requests.Response, None]:
-    """Return the response.
+    Pages are requested in sequence, following the resumption token of each.
+    Pages are not cached (see kb_client), since resumption tokens expire.
 
-    Tries to get response max_attempts number of times, otherwise return None
+    Raises OAIError where a page fails max_attempts times, i.e., the range
+    is only harvested in full where no error is raised. An oai noRecordsMatch
+    error is the (clean) end of an empty range.
 
     Args:
-        url (str): url string to be retrieved
-        max_attemps (int): number of request attempts for same url
-        request_kwargs (dict): kwargs passed to requests.get()
-            timeout = 10 [default]
-
-    E.g.,
-        r = get_response(url, max_attempts=2, timeout=10)
-        r = xmltodict.parse(r.text)
-        # or
-        r = json.load(r.text)
+        from_date (str), until_date (str): YYYY-MM-DD datestamp bounds (inclusive) [default: None, i.e., unbounded]
+        set_spec (str): oai set to harvest [default: None, i.e., all]
+        max_attempts (int): number of attempts at each page, backing off exponentially between
     """
-    # ensure requests.get(timeout=10) default unless over-ridden by kwargs
-    if "timeout" in request_kwargs:
-        pass
+    url = OAI_URL + "?verb=ListRecords&metadataPrefix=didl"
+    if set_spec:
+        url += "&set=" + set_spec
+    if from_date:
+        url += "&from=" + from_date
+    if until_date:
+        url += "&until=" + until_date
+
+    while url:
+        r = get_oai_page(url, max_attempts=max_attempts)
+        if r is None:  # i.e., noRecordsMatch
+            return
+
+        records = r["ListRecords"].get("record", [])
+        yield records if isinstance(records, list) else [records]
+
+        # the token is absent or empty on the last page
+        token = r["ListRecords"].get("resumptionToken")
+        if isinstance(token, dict):
+            token = token.get("#text")
+
+        if token:
+            url = (
+                OAI_URL
+                + "?verb=ListRecords&resumptionToken="
+                + urllib.parse.quote(token)
+            )
+        else:
+            url = None
+
+
+def get_oai_page(url: str, *, max_attempts: int = 5) -> typing.Union[typing.Dict, None]:
+    """Return the (xmltodict parsed) OAI-PMH element of a ListRecords page, or None for noRecordsMatch.
+
+    Failed requests, unparsable (e.g., html or plain text error) bodies and oai
+    errors (e.g., badResumptionToken) are logged and retried, backing off
+    exponentially (1, 2, 4, ... seconds), and OAIError raised after max_attempts.
+    """
+    for attempt in range(max_attempts):
+        response = get_response(url, cache=False)
+        if response is None:
+            error = "no response"
+        else:
+            try:
+                r = xmltodict.parse(response.text)["OAI-PMH"]
+                if "error" not in r:
+                    r["ListRecords"]  # i.e., KeyError where absent
+                    return r
+
+                code = r["error"].get("@code") if isinstance(r["error"], dict) else None
+                if code == "noRecordsMatch":
+                    return None
+                error = f"oai error {code}"
+
+            except (ExpatError, KeyError, TypeError):
+                error = f"unparsable response (status {response.status_code})"
+
+        print(f"{error}: {url} (attempt {attempt + 1} of {max_attempts})")
+        if attempt < max_attempts - 1:
+            time.sleep(2**attempt)
+
+    raise OAIError(f"{error}: {url}")
+
+
+def gen_date_ranges(
+    from_date: str, until_date: str, *, days: int = 30
+) -> typing.Generator:
+    """Yield consecutive (from, until) YYYY-MM-DD pairs of days days, spanning from_date..until_date (inclusive)."""
+    start = datetime.date.fromisoformat(from_date)
+    end = datetime.date.fromisoformat(until_date)
+
+    while start <= end:
+        stop = min(start + datetime.timedelta(days=days - 1), end)
+        yield start.isoformat(), stop.isoformat()
+        start = stop + datetime.timedelta(days=1)
+
+
+def parse_oai_record(record: typing.Dict) -> typing.Dict:
+    """Return kb_oai_metadata, as in metadata.json, of an (xmltodict parsed) oai didl record."""
+    kb_oai_metadata = {}
+    kb_oai_metadata["datestamp"] = record["header"]["datestamp"]
+
+    m = record["metadata"]["didl:DIDL"]["didl:Item"]["didl:Component"][0][
+        "didl:Resource"
+    ]["srw_dc:dcx"]
+
+    kb_oai_metadata["title"] = m["dc:title"]
+    kb_oai_metadata["date"] = m["dc:date"]
+    kb_oai_metadata["temporal"] = m["dcterms:temporal"]
+    kb_oai_metadata["publisher"] = m["dc:publisher"]
+    kb_oai_metadata["spatial_distribution"] = m["dcterms:spatial"][0]
+    kb_oai_metadata["spatial_origin"] = m["dcterms:spatial"][1]["#text"]
+
+    # language edge cases
+    kb_oai_metadata["language"] = []
+    entry = m["dc:language"]
+    if type(entry) == list:
+        for i in entry:
+            kb_oai_metadata["language"].append(i["#text"])
     else:
-        request_kwargs["timeout"] = 10
+        kb_oai_metadata["language"].append(entry["#text"])
 
-    # try max_attempts times
-    for count, x in enumerate(range(max_attempts)):
-        try:
-            response = requests.get(url, **request_kwargs)
-            return response
-        except:
-            time.sleep(0.01)
+    return kb_oai_metadata
 
-    # if count exceeded
-    return None
+
+def to_json(container, filename: str) -> typing.NoReturn:
+    with open(filename, "w") as f:
+        json.dump(container, f, indent=4)
+
+
+def get_json(filename: str):
+    with open(filename, "r") as f:
+        return json.load(f)
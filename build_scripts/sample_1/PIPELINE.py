@@ -46,21 +46,21 @@ def main():
         pass
     else:
         os.system(
-            f"python3 query_kb.py -c queries/Contentious.txt queries/dates_artikel.txt -m {metadata_samples_per_query} -save_dir contentious_words"
+            f"python3 query_kb.py -c queries/Contentious.txt queries/dates_artikel.txt -m {metadata_samples_per_query} -save_dir contentious_words -json"
         )  # output: contentious_words/metadata.json
 
     if os.path.exists("alternative_words/metadata.json"):
         pass
     else:
         os.system(
-            f"python3 query_kb.py -c queries/Alternative.txt queries/dates_artikel.txt -m {metadata_samples_per_query} -save_dir alternative_words"
+            f"python3 query_kb.py -c queries/Alternative.txt queries/dates_artikel.txt -m {metadata_samples_per_query} -save_dir alternative_words -json"
         )  # output: alternative_words/metadata.json
 
     if os.path.exists("additional_words/metadata.json"):
         pass
     else:
         os.system(
-            f"python3 query_kb.py -c queries/Additional.txt queries/dates_artikel.txt -m {metadata_samples_per_query} -save_dir additional_words"
+            f"python3 query_kb.py -c queries/Additional.txt queries/dates_artikel.txt -m {metadata_samples_per_query} -save_dir additional_words -json"
         )  # output: additional_words/metadata.json
 
     # ------
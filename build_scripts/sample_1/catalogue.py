@@ -5,24 +5,43 @@ see catalogue.py -h
 
 """
 import argparse
+import functools
 import json
 import os
 import time
 import typing
-import urllib
+import urllib.parse
 
 import pandas as pd
-import requests
 from tqdm import tqdm
 
+import catalogue_index
+import kb_client
+from harvest import gen_fetched
+
 parser = argparse.ArgumentParser(
     description="""Output europeana_catalogue.csv in current dir: a csv of pairs of europeana_id, delpher link for all newspaper issues returned by query:
 
     https://api.europeana.eu/record/v2/search.json?wskey={pass_key}&query=DATA_PROVIDER:\"National Library of the Netherlands\"&theme=newspaper
 
+    The query is partitioned by year (via the YEAR facet, plus a partition of
+    the items without a year), and the pages of each year are requested concurrently.
+    Incomplete partitions are harvested again, and europeana_catalogue.csv is only
+    written where all partitions are complete and their items add up.
+
+    The start time of each (complete) run is recorded in europeana_catalogue.hwm
+    (a high-water mark), s.t., -update only requests items created or updated since.
+    Where a run is incomplete, the mark is left where it was, s.t., the next
+    -update requests the items it missed.
+
     Example:
 
-        python3 catalogue.py
+        python3 catalogue.py {pass_key}
+
+        python3 catalogue.py {pass_key} -update
+
+            add items created/ updated since the last run to europeana_catalogue.csv
+            (and to europeana_catalogue.db, where indexed, see catalogue_index.py)
 
     Output:
 
@@ -33,6 +52,19 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument("password", nargs=1, type=str)
+parser.add_argument(
+    "-max_in_flight",
+    nargs=1,
+    type=int,
+    default=[10],
+    help="number of partitions (years) harvested concurrently",
+)
+parser.add_argument(
+    "-update",
+    action="store_true",
+    default=False,
+    help="update an existing europeana_catalogue.csv with the items created/ updated since the last run",
+)
 
 
 def main():
@@ -40,62 +72,242 @@ def main():
     args = parser.parse_args()
 
     sav_file = "europeana_catalogue.csv"
-    if os.path.exists(sav_file):  # do not overwrite existing output
+    index_file = "europeana_catalogue.db"
+    hwm_file = "europeana_catalogue.hwm"
+
+    max_in_flight = args.max_in_flight[0]
+    kb_client.configure(pool_size=max_in_flight)
+    max_attempts = 3  # i.e., of each partition, incomplete partitions are harvested again
+
+    items_per_page = 100  # the maximum items that can be shown for a given request to api.europeana.eu
+    base_url = f'https://api.europeana.eu/record/v2/search.json?wskey={args.password[0]}&query=DATA_PROVIDER:"National Library of the Netherlands"&theme=newspaper'
+
+    # the high-water mark of this run, i.e., items updated from here on are picked up by the next -update
+    start: str = get_timestamp()
+
+    if args.update:
+
+        if not os.path.exists(sav_file):
+            print(f"{sav_file} does not exist ... aborting")
+            return
+
+        # items created/ updated since the last run
+        since: str = get_hwm(hwm_file, sav_file)
+        partition = "&qf=" + urllib.parse.quote(f"timestamp_update:[{since} TO *]")
+        (eu_ids, shown_ats), complete = harvest_partition(
+            partition, base_url=base_url, items_per_page=items_per_page
+        )
+        if not complete:
+            # i.e., leave the high-water mark at since, s.t., the next -update requests these items again
+            print(f"could not fetch items updated since {since} ... aborting")
+            return
+        print(f"{len(eu_ids)} items updated since {since}")
+
+        # merge into the catalogue, replacing updated items
+        df = pd.concat(
+            [
+                pd.read_csv(sav_file),
+                pd.DataFrame({"eu_id": eu_ids, "isShownAt": shown_ats}),
+            ]
+        )
+        df = df.drop_duplicates(subset="eu_id", keep="last")
+        write_csv(df, sav_file)
+
+        # merge into the catalogue index (after the csv, s.t., it is not rebuilt)
+        if os.path.exists(index_file):
+            catalogue_index.update_index(zip(eu_ids, shown_ats), index_file)
+
+        set_hwm(hwm_file, start)
+
+    elif os.path.exists(sav_file):  # do not overwrite existing output
 
         print(f"{sav_file} exists ... aborting")
 
     else:
 
-        items_per_page = 100  # the maximum items that can be shown for a given request to api.europeana.eu
-        base_url = f'https://api.europeana.eu/record/v2/search.json?wskey={args["password"]}&query=DATA_PROVIDER:"National Library of the Netherlands"&theme=newspaper&rows={items_per_page}'
+        # split the query into disjoint partitions, i.e., by year
+        n_items, partitions = get_partitions(base_url)
+        print(f"{n_items} items in {len(partitions)} partitions")
+
+        # harvest the pages of each partition (in sequence, via its cursor), and partitions concurrently
+        harvest = functools.partial(
+            harvest_partition, base_url=base_url, items_per_page=items_per_page
+        )
+        progress = tqdm(total=n_items)
+        harvested = {}  # {partition: (eu_id column, isShownAt column)}, of complete partitions
+        failed = partitions
+        for attempt in range(max_attempts):
+            if attempt:
+                print(f"\tretrying {len(failed)} incomplete partitions")
+            failed = []
+            for partition, (columns, complete) in gen_fetched(
+                [partition for partition in partitions if partition not in harvested],
+                f=harvest,
+                max_in_flight=max_in_flight,
+                key=lambda partition: "api.europeana.eu",
+            ):
+                if complete:
+                    harvested[partition] = columns
+                    progress.update(len(columns[0]))
+                else:
+                    failed.append(partition)
+            if not failed:
+                break
+        progress.close()
+
+        if failed:
+            raise RuntimeError(
+                f"partitions {', '.join(failed)} incomplete after {max_attempts} attempts, {sav_file} not written"
+            )
+
+        # columns of eu_id, isShownAt values
+        eu_ids = []
+        shown_ats = []
+        for partition in partitions:
+            eu_ids.extend(harvested[partition][0])
+            shown_ats.extend(harvested[partition][1])
+
+        df = pd.DataFrame({"eu_id": eu_ids, "isShownAt": shown_ats})
+        df = df.drop_duplicates(subset="eu_id")
+        if len(df) != n_items:
+            raise RuntimeError(
+                f"{len(df)} of {n_items} items catalogued, {sav_file} not written"
+            )
+
+        # i.e., only after a complete harvest (see above), items missed are not before the mark
+        write_csv(df, sav_file)
+        set_hwm(hwm_file, start)
+
 
-        df = pd.DataFrame(
-            columns=["eu_id", "isShownAt"]
-        )  # new dataframe for storing pairs of eu_id, isShownAt values
+def get_partitions(base_url: str) -> typing.Tuple[int, typing.List[str]]:
+    """Return (number of items, [query partitions]) of the items matching base_url.
 
-        # iterate over each newspaper issue metadata in europeana.api query response, and add europeana id and delpher link (which contains kb _id) to df.
-        newspapers_metadata = iter_items(base_url, items_per_page)
-        for newspaper_metadata in tqdm(newspapers_metadata):
-            row = [newspaper_metadata["id"], newspaper_metadata["edmIsShownAt"][0]]
-            df.loc[len(df)] = row
+    Partitions are disjoint "&qf=YEAR:..." refinements of base_url, one per year
+    value of the YEAR facet, and one, "&qf=-YEAR:[* TO *]", of the items
+    without a year. Raises RuntimeError where the counts of the partitions do
+    not add up to the number of items.
 
-        with open(sav_file, "w") as f:
-            df.to_csv(f, index=False)
+    Args:
+        base_url: string of request url
+    """
+    response = get_response(
+        base_url + "&rows=0&profile=facets&facet=YEAR&f.YEAR.facet.limit=1000"
+    )
+    if response is None:
+        raise RuntimeError(f"could not fetch: {base_url}")
+    n_items = int(response["totalResults"])
+
+    years = {}  # {year: count}
+    for facet in response.get("facets", []):
+        if facet["name"] == "YEAR":
+            years = {field["label"]: field["count"] for field in facet["fields"]}
+
+    partitions = [f"&qf=YEAR:{year}" for year in sorted(years)]
+    n_partitioned = sum(years.values())
+
+    # items without a year, if any
+    no_year = "&qf=" + urllib.parse.quote("-YEAR:[* TO *]")
+    response = get_response(base_url + no_year + "&rows=0")
+    if response is None:
+        raise RuntimeError(f"could not fetch: {base_url + no_year}")
+    if int(response["totalResults"]):
+        partitions.append(no_year)
+        n_partitioned += int(response["totalResults"])
 
+    if n_partitioned != n_items:
+        raise RuntimeError(
+            f"partitions of {n_partitioned} items do not add up to {n_items} items, e.g., f.YEAR.facet.limit exceeded"
+        )
 
-def iter_items(base_url: str, items_per_page: int) -> typing.Generator:
-    """Return a Generator of metadata dicts for api.europeana.eu items matching base url.
+    return n_items, partitions
 
-        Sifts over subsequent pages corresponding to base_url
+
+def harvest_partition(
+    partition: str, *, base_url: str, items_per_page: int
+) -> typing.Tuple[typing.Tuple[list, list], bool]:
+    """Return ((eu_id column, isShownAt column), complete) of the items of a partition.
+
+    Sifts over subsequent pages corresponding to base_url + partition, via the
+    cursor of each page. Where a page fails (repeatedly), complete is False.
 
     Args:
+        partition: string refining base_url, e.g., "&qf=YEAR:1900"
         base_url: string of request url
         items_per_page: int denoting number of record items requested by response page.
     """
-    n_items: int = int(get_response(base_url + "&start=1")["totalResults"])
+    base_url = base_url + partition
+
+    eu_ids = []
+    shown_ats = []
 
     cursor: str = "*"
-    for start in range(1, n_items, items_per_page):
-        response: typing.Dict = get_response(base_url + f"&cursor={cursor}")
-        cursor = urllib.parse.quote(response["nextCursor"])
+    while cursor:
+        response = get_response(
+            base_url + f"&rows={items_per_page}&cursor={urllib.parse.quote(cursor)}"
+        )
+        if response is None:
+            return (eu_ids, shown_ats), False
 
-        for item in response["items"]:
-            yield item
+        for item in response.get("items", []):
+            eu_ids.append(item["id"])
+            shown_ats.append(item["edmIsShownAt"][0])
 
+        # nextCursor is absent on the last page
+        cursor = response.get("nextCursor") if response.get("items") else None
 
-def get_response(query: str) -> typing.Dict:
+    return (eu_ids, shown_ats), True
+
+
+def get_response(
+    query: str, *, max_attempts: int = 8
+) -> typing.Union[typing.Dict, None]:
     """Return (json) query response as a dict.
 
-    loop until a response is returned if request timeout
+    Tries max_attempts times, backing off exponentially (1, 2, 4, ... seconds)
+    between attempts, e.g., on timeouts or 429 responses, otherwise return None.
     """
-    response = False
-    while response is False:
-        try:
-            response = requests.get(query, timeout=10)
-            d = json.loads(response.text)
-            return d
-        except:
-            time.sleep(0.01)
+    for attempt in range(max_attempts):
+        response = kb_client.get_response(query, max_attempts=1)
+        if response is not None and response.status_code == 200:
+            try:
+                return json.loads(response.text)
+            except ValueError:
+                pass
+        if attempt < max_attempts - 1:
+            time.sleep(2**attempt)
+
+    return None
+
+
+def write_csv(df: pd.DataFrame, sav_file: str) -> typing.NoReturn:
+    """Write df to sav_file, replacing any existing sav_file only once complete."""
+    with open(sav_file + ".temp", "w") as f:
+        df.to_csv(f, index=False)
+    os.replace(sav_file + ".temp", sav_file)
+
+
+def get_timestamp(seconds: float = None) -> str:
+    """Return the (current) UTC time as e.g., 2021-01-06T07:57:47Z, as in europeana timestamp fields."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def get_hwm(hwm_file: str, sav_file: str) -> str:
+    """Return the high-water mark of the last run.
+
+    Where hwm_file is absent (i.e., a catalogue from before hwm_file was
+    recorded), the time sav_file was last written is returned instead.
+    """
+    if os.path.exists(hwm_file):
+        with open(hwm_file, "r") as f:
+            return f.read().strip()
+
+    return get_timestamp(os.path.getmtime(sav_file))
+
+
+def set_hwm(hwm_file: str, timestamp: str) -> typing.NoReturn:
+    """Record timestamp as the high-water mark, i.e., only after a complete harvest of the items since."""
+    with open(hwm_file, "w") as f:
+        f.write(timestamp)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+"""
+Persisted index of europeana_catalogue.csv (see catalogue.py): kb issue id -> europeana issue id
+
+I.e., an SQLite table, europeana_catalogue.db, keyed by kb issue id, built once
+from the catalogue csv (and rebuilt only when the csv changes), s.t., europeana
+ids are attached to kb articles by lookup, rather than by rescanning the csv.
+
+Each (re)build or update of the index records a new revision (a timestamp),
+s.t., stores attaching the index (see Metadata) know when to re-attach ids.
+
+Example:
+    build_index("europeana_catalogue.csv", "europeana_catalogue.db")
+    metadata = Metadata("metadata.db", catalogue_file="europeana_catalogue.db")
+
+    update_index(rows, "europeana_catalogue.db")  # e.g., via catalogue.py -update
+"""
+import csv
+import os
+import re
+import sqlite3
+import time
+import typing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalogue (
+    kb_issue_id TEXT PRIMARY KEY,
+    europeana_issue_id TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS revision (
+    revision REAL NOT NULL
+);
+"""
+
+
+def build_index(
+    csv_file: str = "europeana_catalogue.csv",
+    index_file: str = "europeana_catalogue.db",
+    *,
+    force: bool = False,
+) -> bool:
+    """(Re)build index_file from csv_file where absent or older than csv_file.
+
+    Return True if (re)built, i.e., where europeana ids of existing records may
+    have changed.
+
+    Args:
+        csv_file (str): eu_id, isShownAt pairs, as output by catalogue.py
+        index_file (str): SQLite file of the index
+        force (bool): rebuild regardless
+    """
+    if (
+        not force
+        and os.path.exists(index_file)
+        and os.path.getmtime(index_file) >= os.path.getmtime(csv_file)
+    ):
+        return False
+
+    print(f"indexing {csv_file} in {index_file}")
+
+    # build alongside, and only replace the index once complete
+    temp_file = index_file + ".temp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+
+    db = sqlite3.connect(temp_file)
+    db.executescript(SCHEMA)
+    add_rows(db, gen_csv_rows(csv_file, ignore_rows=[0]))
+    db.close()
+
+    os.replace(temp_file, index_file)
+
+    return True
+
+
+def update_index(
+    rows: typing.Iterable, index_file: str = "europeana_catalogue.db"
+) -> typing.NoReturn:
+    """Merge (eu_id, isShownAt) catalogue rows into an existing index_file.
+
+    Args:
+        rows (iterable): (eu_id, isShownAt) pairs, e.g., new or updated catalogue items
+        index_file (str): SQLite file of the index
+    """
+    db = sqlite3.connect(index_file)
+    db.executescript(SCHEMA)
+    add_rows(db, rows)
+    db.close()
+
+
+def add_rows(db: sqlite3.Connection, rows: typing.Iterable) -> typing.NoReturn:
+    """Add (or replace) the (eu_id, isShownAt) catalogue rows in the index db, as a new revision."""
+    db.executemany(
+        "INSERT OR REPLACE INTO catalogue (kb_issue_id, europeana_issue_id) VALUES (?, ?)",
+        ((get_kb_issue_id(isShownAt), eu_id) for eu_id, isShownAt in rows),
+    )
+    db.execute("DELETE FROM revision")
+    db.execute("INSERT INTO revision (revision) VALUES (?)", (time.time(),))
+    db.commit()
+
+
+def get_kb_issue_id(isShownAt: str) -> str:
+    """Return e.g., 'ddd:110612753:mpeg21' for http://kranten.delpher.nl/nl/view/index?image=ddd:110612753:mpeg21"""
+    return re.search(".+=(.+)", isShownAt).group(1)
+
+
+def gen_csv_rows(path: str, *, ignore_rows: typing.List = []) -> typing.Generator:
+    """Return a generator yielding successive csv rows.
+
+    Will ignore row indices specified in ignore_rows arg.
+
+    Args:
+        path (str): path to csv
+        ignore_rows (list): E.g., title row = [0]
+    """
+    with open(path, "r") as f:
+        for index, line in enumerate(csv.reader(f)):
+            if index not in ignore_rows:
+                yield line
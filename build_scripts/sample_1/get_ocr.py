@@ -10,10 +10,14 @@ import time
 import typing
 from collections import OrderedDict
 
-import requests
 import xmltodict
+from tqdm import tqdm
 from tqdm.contrib.concurrent import thread_map
 
+import kb_client
+from harvest import gen_fetched
+from Metadata import Metadata
+
 parser = argparse.ArgumentParser(
     description="""For those records in metadata.json which which oai metadata exists: retrieve ocr text for a specified sample size, and save as a new container.
 
@@ -28,6 +32,11 @@ parser = argparse.ArgumentParser(
             extract ocr text for 1000 random sample records with metadata in
             metadata.json and output ocr.json in contentious_words folder.
 
+        python3 get_ocr.py -f contentious_words/metadata.db -all -save_dir contentious_words -jsonl
+
+            as above, but write each record to ocr.jsonl as soon as it is
+            retrieved, i.e., w/o holding the retrieved ocr in memory.
+
     Output:
 
         ocr.json : [
@@ -64,10 +73,14 @@ parser = argparse.ArgumentParser(
             ...
         ]
 
+        ocr.jsonl (-jsonl only): a [url, metadata, ocr] record per line, in order of retrieval, e.g.,
+            ["http://resolver.kb.nl/resolve?urn=ddd:110540397:mpeg21:a0037:ocr", {"europeana_issue_id": ...}, {"text": {"title": "Cricket.", "p": ...}}]
+            ...
+
     """,
     formatter_class=argparse.RawTextHelpFormatter,
 )
-parser.add_argument("-f", nargs=1, help="file path to metadata.json")
+parser.add_argument("-f", nargs=1, help="file path to metadata.json (or metadata.db)")
 
 selection_group = parser.add_mutually_exclusive_group()
 selection_group.required = True
@@ -75,6 +88,19 @@ selection_group.add_argument("-all", action="store_true", default=False)
 selection_group.add_argument("-s", nargs=1, help="number of random extracts to extract")
 
 parser.add_argument("-o", nargs=1, help="dir to save ocr.json output")
+parser.add_argument(
+    "-jsonl",
+    action="store_true",
+    default=False,
+    help="stream records to ocr.jsonl as retrieved, rather than ocr.json",
+)
+parser.add_argument(
+    "-max_in_flight",
+    nargs=1,
+    type=int,
+    default=[kb_client.POOL_SIZE],
+    help="number of concurrent ocr requests (-jsonl only)",
+)
 
 
 def main():
@@ -84,31 +110,57 @@ def main():
     # deal with location if specified
     save_folder = args.o[0] + "/" if args.o else ""
 
-    # import the saved metadata
-    print("import metadata.json")
-    metadata = get_json(args.f[0])
-    queries = metadata.pop("queries")  # useless info for this task
-
-    # get the metadata subset with metadata
-    metadata_queried = {
-        url: data
-        for url, data in metadata.items()
-        if data["kb_oai_metadata_queried"] is not False
-    }
+    # import the saved metadata, and get the metadata subset with metadata
+    if args.f[0].endswith(".json"):
+        print("import metadata.json")
+        metadata = get_json(args.f[0])
+        queries = metadata.pop("queries")  # useless info for this task
+
+        metadata_queried = {
+            url: data
+            for url, data in metadata.items()
+            if data["kb_oai_metadata_queried"] is not False
+        }
+    else:
+        print(f"import {args.f[0]}")
+        metadata_queried = dict(Metadata(args.f[0]).gen_records(queried_only=True))
 
     # select a random sample of metadata records (or all)
     if args.all:
         print(f"sample size = {len(metadata_queried)}")
         sample: typing.List = metadata_queried.items()
     else:
-        print(f"sample size = {len(int(args.s[0]))}")
-        sample: typing.List = random.sample(metadata_queried.items(), int(args.s[0]))
+        print(f"sample size = {int(args.s[0])}")
+        sample: typing.List = random.sample(
+            list(metadata_queried.items()), int(args.s[0])
+        )
     # sample = [(url, data), ...]
 
     # for each selected metadata record, get ocr
     print("retrieve ocr text for article in metadata.json samples for metadata")
-    output: typing.List = thread_map(get_ocr, sample)
+
+    if args.jsonl:
+        # write each (url, metadata, ocr) as it completes, max_in_flight at a time
+        max_in_flight = args.max_in_flight[0]
+        kb_client.configure(pool_size=max_in_flight)
+
+        with open(save_folder + "ocr.jsonl", "w") as f:
+            for _, output in tqdm(
+                gen_fetched(
+                    sample,
+                    f=get_ocr,
+                    max_in_flight=max_in_flight,
+                    key=lambda record: "resolver.kb.nl",
+                ),
+                total=len(sample),
+            ):
+                f.write(json.dumps(output, ensure_ascii=False) + "\n")
+        kb_client.print_stats()
+        return
+
+    output: typing.List = thread_map(get_ocr, sample, max_workers=kb_client.POOL_SIZE)
     # output = [(url, metadata, ocr), ...]
+    kb_client.print_stats()
 
     # output
     to_json(output, save_folder + "ocr.json")
@@ -128,10 +180,9 @@ def get_xml(url: str) -> OrderedDict:
     count = 0
     while count < 5:
         try:
-            response = requests.get(url, timeout=5)
-            d: OrderedDict = xmltodict.parse(
-                response.text.encode("latin1").decode("utf8")
-            )
+            response = kb_client.get_response(url, max_attempts=1, timeout=5)
+            # parse the bytes, i.e., decoded as declared by the xml (utf8)
+            d: OrderedDict = xmltodict.parse(response.content)
             return d
         except:
             time.sleep(0.01)
@@ -1,38 +1,44 @@
-"""Return metadata.json and count_kb.csv, count_eu.csv
+"""Return metadata.db (optionally, metadata.json) and count_kb.csv, count_eu.csv
 
 see python3 query_kb.py -h
 """
 import argparse
-import concurrent.futures
-import csv
+import functools
 import typing
 from collections import defaultdict
 import os
 import itertools
+import time
+import xml.etree.ElementTree as ET
 
 import pandas as pd
 import requests
-import xmltodict
 from tqdm import tqdm
 
-from Metadata import Metadata
+import kb_client
+import sru
+from catalogue_index import build_index
+from harvest import gen_fetched
+from kb_client import get_response
+from Metadata import Metadata, OAIError, gen_date_ranges
 
 # CL arguments
 parser = argparse.ArgumentParser(
-    description="""Query KB apis and return metadata.json and count_kb.csv, count_eu.csv
+    description="""Query KB apis and return metadata.db and count_kb.csv, count_eu.csv
 
     Requirements: europeana_catalogue.csv, as an output from catalogue.py, in the
-    same dir as the query_kb.py
+    same dir as the query_kb.py (indexed once in europeana_catalogue.db, see
+    catalogue_index.py)
 
     Example:
 
         python3 query_kb.py -s 'allochtoon AND type=artikel'
 
-            report query count, and save metadata.json in current dir reflecting query
+            report query count, and save metadata.db in current dir reflecting query
 
         python3 query_kb.py -c queries_words.txt queries_dates.txt -save_dir=output_dir
 
-            - updata output_dir/metadata.json, resulting from the every
+            - updata output_dir/metadata.db, resulting from the every
                 query combination of queries_words.txt and queries_dates.txt.
             - overwrite output_dir/count_kb.csv and output_dir/count_eu, with
               respect to the query combination of the newly passes queries only
@@ -40,19 +46,31 @@ parser = argparse.ArgumentParser(
         python3 query_kb.py -c queries_words.txt queries_dates.txt -m 200 -save_dir=output_dir
 
             As above, plus for every query combination, 200 are selected at random (or as many as available),
-            metadata is retrieved and metadata.json updated to include this metadata.
+            metadata is retrieved and metadata.db updated to include this metadata.
+
+        python3 query_kb.py -c queries_words.txt queries_dates.txt -m 200 -oai_harvest 2020-01-01 2021-12-31 -save_dir=output_dir
+
+            As above, but first harvest (in bulk) the oai metadata of all issues
+            whose oai record was last modified in 2020-2021, s.t., the metadata
+            of selected articles is (where available) looked up locally.
+
+        python3 query_kb.py -c queries_words.txt queries_dates.txt -save_dir=output_dir -json
+
+            As above, and export output_dir/metadata.db to output_dir/metadata.json
 
     Output:
 
-        metadata.json:
-            A dictionary of urls to kb ocr records and associated data:
+        metadata.db:
+            An SQLite store (see Metadata.py) of urls to kb ocr records and associated data:
                 * An entry is stored for all kb articles matching any query.
                 * where an entry is randomnly selected as part of the -m query,
                 metadata is appended to the record
-                * a record of all previous queries is appended to the end of
-                metadata.json
+                * a record of all previous queries
+            Records are written as they are retrieved, i.e., a re-run only
+            costs time proportional to the new queries. An existing
+            output_dir/metadata.json (of an earlier version) is imported once.
 
-        metadata.json: {
+        metadata.json (-json only): {
             "http://resolver.kb.nl/resolve?urn=ddd:110546794:mpeg21:a0114:ocr": {
                 "europeana_issue_id": "/9200359/BibliographicResource_3000115848627",
                 "kb_issue_id": "ddd:110546794:mpeg21",
@@ -120,10 +138,39 @@ query_group.add_argument(
 
 # other optional arguments
 parser.add_argument("-m", nargs=1, default=["0"], help="")
+parser.add_argument(
+    "-seed",
+    nargs=1,
+    type=int,
+    help="seed of the -m random selection, for a reproducible selection",
+)
 parser.add_argument(
     "-save_dir",
     nargs=1,
-    help="directory from which to import metadata.json and save metadata.json, and .csv",
+    help="directory from which to import and save metadata.db, and .csv",
+)
+parser.add_argument(
+    "-json",
+    action="store_true",
+    default=False,
+    help="also export metadata.db to metadata.json",
+)
+parser.add_argument(
+    "-oai_harvest",
+    nargs=2,
+    metavar=("FROM", "UNTIL"),
+    help="before -m, harvest the oai metadata of all issues with an oai datestamp in FROM..UNTIL (YYYY-MM-DD) in bulk, s.t., -m metadata is looked up locally",
+)
+parser.add_argument(
+    "-oai_set",
+    nargs=1,
+    help="oai set to which -oai_harvest is restricted",
+)
+parser.add_argument(
+    "-no_cache",
+    action="store_true",
+    default=False,
+    help="do not serve jsru.kb.nl and oai responses from (or store them in) kb_cache.sqlite",
 )
 
 
@@ -131,22 +178,33 @@ def main():
 
     args = parser.parse_args()
 
-    # location to save metadata.json, count_kb.csv, and count_eu.csv
+    # keep-alive connection pool per host, sized to the 50 worker threads below
+    kb_client.configure(pool_size=50)
+
+    # re-runs only hit the network for queries not previously requested
+    if not args.no_cache:
+        kb_client.enable_cache("kb_cache.sqlite")
+
+    # location to save metadata.db, count_kb.csv, and count_eu.csv
     save_location = args.save_dir[0] + "/" if args.save_dir else ""
     # touch sav_dir
     if save_location != "":
         os.makedirs(os.path.dirname(save_location), exist_ok=True)
 
-    # load metadata if exists or create new metadata object
-    if args.save_dir:
-        metadata = Metadata(save_location + "metadata.json")
+    # index eu_id, delpher_url pairs of europeana_catalogue.csv by kb issue id
+    #   - (re)built only where europeana_catalogue.csv is newer than the index
+    catalogue_file = None
+    if os.path.exists("europeana_catalogue.csv"):
+        build_index("europeana_catalogue.csv", "europeana_catalogue.db")
+    if os.path.exists("europeana_catalogue.db"):
+        catalogue_file = "europeana_catalogue.db"
     else:
-        metadata = Metadata("metadata.json")
+        print("notice: no europeana_catalogue.csv, europeana ids not attached (see catalogue.py)")
 
-    # load eu_id, delpher_url pairs from europeana_catalogue.csv
-    europeana_catalogue: typing.Generator = gen_csv_rows(
-        "europeana_catalogue.csv", ignore_rows=[0]
-    )
+    # load metadata if exists or create new metadata object
+    #   - europeana ids are attached as urls are added, via the catalogue index
+    #   - where the catalogue changed, ids are (re-)attached to existing records
+    metadata = Metadata(save_location + "metadata.db", catalogue_file=catalogue_file)
 
     # Build query iterable
     print("\tbuilding search queries")
@@ -163,20 +221,18 @@ def main():
     search_queries_t1, search_queries_t2 = itertools.tee(search_queries,2)
 
     print(
-        "\n\tquery jsru.kb.nl for query-matching kb articles, and add article records to metadata.json, and record article counts by query"
+        "\n\tquery jsru.kb.nl for query-matching kb articles, and add article records to metadata.db, and record article counts by query"
     )
 
     # depending on query format ...
     if args.s or args.w:
 
-        # dicts to store article counts
-        count_eu = {}
-        count_kb = {}
+        queries = []  # passed queries, in order
 
         # iterate over passed query contents
         for search_query in tqdm(search_queries_t1, desc="queries", leave=True):
 
-            # ignore queries already included in metadata.json
+            # ignore queries already included in metadata.db
             if search_query not in metadata.queries:
                 print(f"\n\n\t{search_query}")
 
@@ -184,23 +240,25 @@ def main():
                     search_query
                 )  # iterable of 'http://resolver.kb.nl/resolve?urn=ddd:010567709:mpeg21:a0493:ocr' items matching the query
 
-                metadata.add_urls(
-                    kb_ocr_urls, search_query
-                )  # add any new ocr urls to metadata and/or associated queries with url
+                # add any new ocr urls (with europeana_id) to metadata and/or associated queries with url
+                #   - an incomplete harvest is not marked complete, i.e., is re-harvested on the next run
+                try:
+                    metadata.add_urls(kb_ocr_urls, search_query)
+                except IncompleteHarvest as e:
+                    print(f"notice: {e}, to be re-harvested on the next run")
 
-                metadata.add_europeana_ids(
-                    europeana_catalogue
-                )  # associate the europeana_id with the ocr url
+            queries.append(search_query)
 
-            # from metadata.json, get a count of article matches for current query
-            count_eu[search_query] = [metadata.get_europeana_match_count(search_query)]
-            count_kb[search_query] = [metadata.get_kb_match_count(search_query)]
+        # from metadata.db, get a count of article matches for every query, in one pass
+        counts = metadata.get_match_counts(queries)
+
+        # dicts to store article counts
+        count_kb = {query: [counts[query][0]] for query in queries}
+        count_eu = {query: [counts[query][1]] for query in queries}
 
     elif args.c:
 
-        headers = []
-        count_eu = defaultdict(list)
-        count_kb = defaultdict(list)
+        combinations = []  # passed (row, column) query parts, in order
 
         # iterate over passed query content tuples
         for row, column in tqdm(search_queries_t1, desc="queries"):
@@ -215,12 +273,26 @@ def main():
                     search_query
                 )  # iterable of 'http://resolver.kb.nl/resolve?urn=ddd:010567709:mpeg21:a0493:ocr' items matching the query
 
-                metadata.add_urls(kb_ocr_urls, search_query)
-                metadata.add_europeana_ids(europeana_catalogue)
+                try:
+                    metadata.add_urls(kb_ocr_urls, search_query)
+                except IncompleteHarvest as e:
+                    print(f"notice: {e}, to be re-harvested on the next run")
 
-            # from metadata.json, get a count of article matches for current query
-            count_eu[column].append(metadata.get_europeana_match_count(search_query))
-            count_kb[column].append(metadata.get_kb_match_count(search_query))
+            combinations.append((row, column))
+
+        # from metadata.db, get a count of article matches for every query, in one pass
+        counts = metadata.get_match_counts(
+            row + " AND " + column for row, column in combinations
+        )
+
+        # dicts to store article counts, i.e., {column: [count for each row], "": rows}
+        headers = []
+        count_eu = defaultdict(list)
+        count_kb = defaultdict(list)
+        for row, column in combinations:
+            kb_count, eu_count = counts[row + " AND " + column]
+            count_kb[column].append(kb_count)
+            count_eu[column].append(eu_count)
 
             if row not in headers:
                 headers.append(row)
@@ -241,32 +313,67 @@ def main():
     pd.DataFrame.from_dict(count_eu).transpose().to_csv(save_location + "count_eu.csv")
     pd.DataFrame.from_dict(count_kb).transpose().to_csv(save_location + "count_kb.csv")
 
+    #
+    # if -oai_harvest passed: harvest issue metadata in bulk
+    #
+    if args.oai_harvest:
+        print("\n\n\tharvesting oai issue metadata")
+        try:
+            metadata.harvest_issue_metadata(
+                gen_date_ranges(*args.oai_harvest),
+                set_spec=args.oai_set[0] if args.oai_set else None,
+            )
+        except OAIError as e:
+            # issues of failed ranges are requested one by one by -m, where selected
+            print(f"notice: {e}, re-run -oai_harvest for these ranges")
+
     #
     # if -m passed: randomnly sample n
     #
     if args.m[0] != "0":
         print(f"\n\n\tgetting random sample kb&eu records matching")
+        seed = args.seed[0] if args.seed else None
         if args.c:
             metadata.add_metadata(
                 [q1 + " AND " + q2 for q1, q2 in search_queries_t2],
                 int(args.m[0]),
+                seed=seed,
             )
         else:
-            metadata.add_metadata(search_queries_t2, int(args.m[0]))
+            metadata.add_metadata(search_queries_t2, int(args.m[0]), seed=seed)
 
     #
-    # save updated metadata.json
+    # metadata.db is saved as it is updated, merge its log
     #
-    metadata.to_json(save_location + "metadata.json")
+    metadata.compact()
+    if args.json:
+        metadata.to_json(save_location + "metadata.json")
+
+    print("\n\trequests made:")
+    kb_client.print_stats()
 
 
-def gen_kb_urls(query: str) -> typing.Generator:
+class IncompleteHarvest(Exception):
+    """Raised by gen_kb_urls (once all pages are tried) where not all records matching a query were harvested."""
+
+
+def gen_kb_urls(query: str, *, max_rounds: int = 5) -> typing.Generator:
     """Return an generator of urls to KB ocr files matching a query.
 
     e.g., http://resolver.kb.nl/resolve?urn=ABCDDD:010842133:mpeg21:a0368:ocr
 
+    Pages of records are planned by a PagePlanner, i.e., page sizes adapt to
+    the server latency, where the first page is requested alone, s.t., the
+    first window of concurrent pages is sized by its latency. Failed pages are
+    re-requested (after an exponential backoff) for up to max_rounds rounds.
+
+    Raises IncompleteHarvest (after yielding all urls harvested) where the
+    number of records harvested falls short of the number matching the query,
+    s.t., the query is not recorded as complete (see Metadata.add_urls).
+
     Args:
         query (str): query to pass to jsru.kb.nl .... e.g., Allochtoon
+        max_rounds (int): number of attempts at each page
     """
 
     base_url = (
@@ -278,108 +385,151 @@ def gen_kb_urls(query: str) -> typing.Generator:
 
     # get number of records matching query, n
     response = get_response(
-        base_url + "&startRecord=1&maximumRecords=1" + f"&query=({query})"
+        base_url + "&startRecord=1&maximumRecords=1" + f"&query=({query})",
+        stream=True,
     )
-    response = xmltodict.parse(response.text)
-    n: int = int(response["srw:searchRetrieveResponse"]["srw:numberOfRecords"])
+    n: int = sru.get_number_of_records(response)
+
+    planner = PagePlanner(n)
+    get_query_page = functools.partial(get_page, base_url=base_url, query=query)
 
-    # get urls for each sub-page of the metadata index
-    index_URLS = (
-        base_url + f"&startRecord={i}&maximumRecords=1000" + f"&query=({query})"
-        for i in range(1, n, 1000)
+    # for each (startRecord, maximumRecords) page, yield record ocr urls as pages
+    # complete; re-request failed pages in subsequent rounds
+    harvested = 0
+    pages: typing.Iterator = planner.gen_pages()
+
+    # request the first page alone, s.t., the pages of the first window are sized by its latency
+    first_page = next(pages, None)
+    fetched: typing.Iterator = itertools.chain(
+        [(first_page, get_query_page(first_page))] if first_page else [],
+        gen_fetched(pages, f=get_query_page, max_in_flight=50),
     )
 
-    # for each metadata index sub-page request response, transform xml to dict, iterate over dicts and yield record ocr url
-    for url, response in gen_threaded(index_URLS, f=get_response, max_workers=50):
-        if response is not None:
-            response_as_dict = xmltodict.parse(response.text)
-            records: typing.List = response_as_dict["srw:searchRetrieveResponse"][
-                "srw:records"
-            ]["srw:record"]
-            for r in records:
-                yield r["srw:recordData"]["dc:identifier"]
+    for attempt in range(max_rounds):
 
+        failed = []
+        for page, (urls, n_records, seconds) in fetched:
+            if urls is None:
+                failed.append(page)
+            else:
+                planner.add_latency(page, seconds)
+                harvested += n_records
+                yield from urls
 
-def gen_threaded(
-    iterable: typing.Iterable,
-    *,
-    f: typing.Callable,
-    max_workers: int = None,
-    chunk_size=None,
-) -> typing.Generator:
-    """Return a generator yielding tuple (item, f(item)), for passed iterable.
+        if not failed:
+            break
 
-    For I/O intensive processes.
-    see: https://docs.python.org/3/library/concurrent.futures.html
+        print(f"\tretrying {len(failed)} failed pages")
+        time.sleep(2**attempt)
+        fetched = gen_fetched(failed, f=get_query_page, max_in_flight=50)
 
-    Examples:
-        g = gen_threaded(urls, f=get_response)
-        url, response = next(g)
+    if harvested != n:
+        raise IncompleteHarvest(f"{harvested} of {n} records harvested for {query}")
 
-        g = gen_threaded(urls, f=partial(get_response, max_attempts = 1))
-        url, response = next(g)
 
-    Args:
-        iter [iterable]:
-        f [callable]: Does not accept lambdas
-        chunk_size (int): concurrent.futures is greedy and will evaluate all of
-            the iterable at once. chunk_size limits the length of iterable
-            evaluated at any one time (and hence, loaded into memory).
-            [default: chunk_size=len(iterable)]
-    """
-    # concurrent.futures will greedily evaluate and store in memory, hence
-    # chunking to limit the scale of greedy evaluation
-    if chunk_size:
-        chunks = gen_chunks(iterable, chunk_size)
-    else:
-        # chunks = map(lambda i: iterable, range(1))  # chunks contains a single chunk
-        chunks = [iterable]
+class PagePlanner(object):
+    """Plan the (startRecord, maximumRecords) pages spanning records 1..n of a query.
 
-    for chunk in chunks:
+    The page size is adapted to the server: pages are sized such that a page is
+    expected to take target_latency seconds, as estimated from a moving
+    average of the latency per record of completed pages.
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    Pages are snapped to a fixed grid, s.t., the page urls (and, as such, the
+    responses cached by kb_client) are the same from run to run: a page is of
+    one of page_sizes, each a multiple of the next smaller, and starts at a
+    multiple of its size (+1), e.g., (1, 1000), (1001, 500), (1501, 100), ...
 
-            future_items = {executor.submit(f, item): item for item in chunk}
+    Args:
+        n (int): number of records matching the query
+        page_size (int): initial page size
+        page_sizes (tuple): sizes of the grid, ascending
+        target_latency (float): seconds per page aimed for (c.f., the 10s request timeout)
+    """
 
-            for future in concurrent.futures.as_completed(future_items):
-                yield (future_items[future], future.result())
+    def __init__(
+        self,
+        n: int,
+        *,
+        page_size: int = 1000,
+        page_sizes: typing.Tuple[int, ...] = (100, 500, 1000),
+        target_latency: float = 3.0,
+    ):
+        self.n = n
+        self.page_size = page_size
+        self.page_sizes = page_sizes
+        self.target_latency = target_latency
+        self.seconds_per_record: typing.Union[float, None] = None
+
+    def gen_pages(self) -> typing.Generator:
+        """Yield (startRecord, maximumRecords) pages, sized at the time each is planned."""
+        start = 1
+        while start <= self.n:
+            size = self.get_grid_size(start)
+            yield (start, min(size, self.n - start + 1))
+            start += size
+
+    def get_grid_size(self, start: int) -> int:
+        """Return the largest of page_sizes, up to page_size, that a page at start may be."""
+        fits = [
+            size
+            for size in self.page_sizes
+            if size <= self.page_size and (start - 1) % size == 0
+        ]
+        return max(fits) if fits else self.page_sizes[0]
+
+    def add_latency(self, page: typing.Tuple[int, int], seconds: float):
+        """Update the page size given the latency of a completed page."""
+        start, size = page
+        alpha = 0.2  # weight of the latest page in the moving average
+
+        if self.seconds_per_record is None:
+            self.seconds_per_record = seconds / size
+        else:
+            self.seconds_per_record = (
+                alpha * seconds / size + (1 - alpha) * self.seconds_per_record
+            )
 
+        if self.seconds_per_record > 0:
+            self.page_size = int(
+                min(
+                    self.page_sizes[-1],
+                    max(
+                        self.page_sizes[0],
+                        self.target_latency / self.seconds_per_record,
+                    ),
+                )
+            )
+        else:
+            self.page_size = self.page_sizes[-1]  # e.g., served from the cache
 
-def get_response(
-    url: str, *, max_attempts=5, **request_kwargs
-) -> typing.Union[requests.Response, None]:
-    """Return the response.
 
-    Tries to get response max_attempts number of times, otherwise return None
+def get_page(
+    page: typing.Tuple[int, int], *, base_url: str, query: str
+) -> typing.Tuple[typing.Union[list, None], int, float]:
+    """Return ([ocr urls of the records on the page] or None if failed, number of records, seconds taken).
 
     Args:
-        url (str): url string to be retrieved
-        max_attemps (int): number of request attempts for same url
-        request_kwargs (dict): kwargs passed to requests.get()
-            timeout = 10 [default]
-
-    E.g.,
-        r = get_response(url, max_attempts=2, timeout=10)
-        r = xmltodict.parse(r.text)
-        # or
-        r = json.load(r.text)
+        page (tuple): (startRecord, maximumRecords)
+        base_url (str): the jsru searchRetrieve url
+        query (str): query to pass to jsru.kb.nl
     """
-    # ensure requests.get(timeout=10) default unless over-ridden by kwargs
-    if "timeout" in request_kwargs:
-        pass
-    else:
-        request_kwargs["timeout"] = 10
+    start, size = page
+    url = base_url + f"&startRecord={start}&maximumRecords={size}" + f"&query=({query})"
 
-    # try max_attempts times
-    for count, x in enumerate(range(max_attempts)):
-        try:
-            response = requests.get(url, **request_kwargs)
-            return response
-        except:
-            time.sleep(0.01)
+    begin = time.perf_counter()
+    response = get_response(url, stream=True)
+    if response is None:
+        return None, 0, time.perf_counter() - begin
+
+    try:
+        records = list(sru.gen_records(response))
+    except (requests.RequestException, ET.ParseError):
+        print(f"could not fetch: {url}")
+        return None, 0, time.perf_counter() - begin
 
-    # if count exceeded
-    return None
+    urls = [record["dc:identifier"] for record in records if "dc:identifier" in record]
+
+    return urls, len(records), time.perf_counter() - begin
 
 
 def gen_file_lines(path: str, *, strip: list = ["\n"]) -> typing.Generator:
@@ -429,57 +579,5 @@ def gen_file_lines_combinations(paths: typing.Iterable) -> typing.Generator:
         yield combination
 
 
-def gen_csv_rows(path: str, *, ignore_rows: typing.List = []) -> typing.Generator:
-    """Return a generator yielding successive csv rows.
-
-    Will ignore row indices specified in ignore_rows arg.
-
-    Args:
-        path (str): path to csv
-        ignore_rows (list): E.g., title row = [0]
-    """
-    with open(path, "r") as f:
-        for index, line in enumerate(csv.reader(f)):
-            if index not in ignore_rows:
-                yield line
-
-
-def get_response(
-    url: str, *, max_attempts=5, **request_kwargs
-) -> typing.Union[requests.Response, None]:
-    """Return the response.
-
-    Tries to get response max_attempts number of times, otherwise return None
-
-    Args:
-        url (str): url string to be retrieved
-        max_attemps (int): number of request attempts for same url
-        request_kwargs (dict): kwargs passed to requests.get()
-            timeout = 10 [default]
-
-    E.g.,
-        r = get_response(url, max_attempts=2, timeout=10)
-        r = xmltodict.parse(r.text)
-        # or
-        r = json.load(r.text)
-    """
-    # ensure requests.get(timeout=10) default unless over-ridden by kwargs
-    if "timeout" in request_kwargs:
-        pass
-    else:
-        request_kwargs["timeout"] = 10
-
-    # try max_attempts times
-    for count, x in enumerate(range(max_attempts)):
-        try:
-            response = requests.get(url, **request_kwargs)
-            return response
-        except:
-            time.sleep(0.01)
-
-    # if count exceeded
-    return None
-
-
 if __name__ == "__main__":
     main()
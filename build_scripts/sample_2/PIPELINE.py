@@ -2,25 +2,123 @@
 
 sample contentious, alternative and additional extracts
 
+I.e., as sample.py for each stream, where the corpus of each stream is loaded,
+and its extracts found and sampled, in a process of its own (concurrently),
+and the -N extracts of each stream are then drawn without duplicates across
+streams (i.e., an extract drawn for one stream is not drawn for another).
+
+Output:
+    {stream}_words/sampled.csv, {stream}_words/sampled.json, as sample.py
+    sampled.csv, of all streams, with a stream column
+
 Run:
     python3 PIPELINE.py
+
+    python3 PIPELINE.py -seed 1  # a reproducible sample
 """
+import argparse
 import os
+import random
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import sample
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""Sample contentious, alternative and additional extracts, see PIPELINE.py""",
+)
+parser.add_argument(
+    "-seed",
+    nargs=1,
+    type=int,
+    help="seed of the random sampling, for a reproducible sample",
+)
+parser.add_argument(
+    "-max_workers",
+    nargs=1,
+    type=int,
+    help="number of streams sampled concurrently [default: number of streams]",
+)
+
+# streams, in the order extracts are drawn, i.e., earlier streams take precedence for extracts in several
+STREAMS = {
+    "contentious": {"adjacent": 2, "n": 2, "N": 1200},
+    "alternative": {"adjacent": 2, "n": 12, "N": 1200},
+    "additional": {"adjacent": 2, "n": 1, "N": 300},
+}
 
 
 def main():
 
-    os.system(
-        "python3 sample.py -data ../score/contentious_words/scored.json -q sampling_criteria/contentious_criteria.txt -s sampling_criteria/spatial.txt -a 2 -n 2 -N 1200 -sav_dir contentious_words"
-    )
+    args = parser.parse_args()
+    seed = args.seed[0] if args.seed else None
+    max_workers = args.max_workers[0] if args.max_workers else len(STREAMS)
+
+    # ------
+    # load, find and sample the extracts of each stream, concurrently
+    # ------
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            stream: executor.submit(
+                sample.get_sampled_by_query,
+                get_data(stream),
+                queries_file=f"sampling_criteria/{stream}_criteria.txt",
+                spatial_file="sampling_criteria/spatial.txt",
+                adjacent=params["adjacent"],
+                n=params["n"],
+                rng=np.random.default_rng(get_seed(seed, index)),
+            )
+            for index, (stream, params) in enumerate(STREAMS.items())
+        }
+        sampled_by_stream = {
+            stream: future.result() for stream, future in futures.items()
+        }
+
+    # ------
+    # draw -N extracts of each stream, w/o duplicates across streams
+    # ------
+    seen = set()  # (url, extract) of all drawn extracts
+    dfs = []
+    for index, (stream, params) in enumerate(STREAMS.items()):
 
-    os.system(
-            "python3 sample.py -data ../score/alternative_words/scored.json -q sampling_criteria/alternative_criteria.txt -s sampling_criteria/spatial.txt -a 2 -n 12 -N 1200 -sav_dir alternative_words"
+        drawn: typing.List = sample.draw_round_robin(
+            sampled_by_stream[stream],
+            params["N"],
+            rng=random.Random(get_seed(seed, index)),
+            seen=seen,
+            key=lambda data: (data[0], data[2]),
         )
+        print(f"{stream}: {len(drawn)} of {params['N']} extracts drawn")
+
+        sav_dir = f"{stream}_words/"
+        os.makedirs(sav_dir, exist_ok=True)
+        sample.save_sample(drawn, sav_dir)
+
+        df = pd.DataFrame.from_dict(sample.get_new_data(drawn))
+        df.insert(0, "stream", stream)
+        dfs.append(df)
+
+    pd.concat(dfs, ignore_index=True).to_csv("sampled.csv")
+
+
+def get_data(stream: str) -> str:
+    """Return the path to the scored articles of stream, preferring .parquet, then .jsonl, over .json."""
+    for extension in [".parquet", ".jsonl"]:
+        path = f"../score/{stream}_words/scored{extension}"
+        if os.path.exists(path):
+            return path
+
+    return f"../score/{stream}_words/scored.json"
+
+
+def get_seed(seed: int, index: int) -> typing.Union[int, None]:
+    """Return the seed of the index-th stream, where seeded."""
+    return None if seed is None else seed + index
 
-    os.system(
-        "python3 sample.py -data ../score/additional_words/scored.json -q sampling_criteria/additional_criteria.txt -s sampling_criteria/spatial.txt -a 2 -n 1 -N 300 -sav_dir additional_words"
-    )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,260 @@
+"""
+Columnar (Parquet) corpus of scored articles, a row per sentence, see "python3 corpus.py -h"
+
+I.e., scored.json (or scored.jsonl) of [url, metadata, {"text": {"s": [...], "neg_log_probability": [...]}}]
+articles, as columns:
+
+    url: str  # e.g., http://resolver.kb.nl/resolve?urn=ddd:110540397:mpeg21:a0037:ocr
+    sentence_index: int  # position of the sentence in the article
+    sentence: str
+    neg_log_probability: float
+    spatial_distribution: str  # i.e., metadata["kb_oai_metadata"]["spatial_distribution"]
+    spatial_origin: str
+    matching_queries: str  # i.e., metadata["matching_queries"], "\n" separated
+    metadata: str  # json of the article metadata
+
+Rows are in article order (and sentence order within an article). The
+article-level columns are dictionary encoded, i.e., stored (and, as read by
+read_corpus, held in memory) once per article rather than once per sentence.
+Columns are read memory-mapped, s.t., filtering (see get_articles) is vectorized
+over the columns (predicates on article-level columns are evaluated once per
+dictionary value), and only the matching articles are materialized.
+
+Example:
+    python3 corpus.py ../score/contentious_words/scored.json ../score/contentious_words/scored.parquet
+
+    articles = get_articles("scored.parquet", queries=queries, spatial_distributions=["Landelijk"])
+"""
+import argparse
+import itertools
+import json
+import typing
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""Convert scored articles (.json, or .jsonl of an article per line) to a Parquet corpus of a row per sentence
+
+    Example:
+        python3 corpus.py ../score/contentious_words/scored.json ../score/contentious_words/scored.parquet
+    """,
+)
+parser.add_argument("data", nargs=1, help="path to scored.json or scored.jsonl")
+parser.add_argument("sav", nargs=1, help="path to output scored.parquet")
+
+SCHEMA = pa.schema(
+    [
+        ("url", pa.dictionary(pa.int32(), pa.string())),
+        ("sentence_index", pa.int32()),
+        ("sentence", pa.string()),
+        ("neg_log_probability", pa.float64()),
+        ("spatial_distribution", pa.dictionary(pa.int32(), pa.string())),
+        ("spatial_origin", pa.dictionary(pa.int32(), pa.string())),
+        ("matching_queries", pa.dictionary(pa.int32(), pa.string())),
+        ("metadata", pa.dictionary(pa.int32(), pa.string())),
+    ]
+)
+DICTIONARY_COLUMNS = [
+    "url",
+    "spatial_distribution",
+    "spatial_origin",
+    "matching_queries",
+    "metadata",
+]
+
+
+def main():
+
+    args = parser.parse_args()
+
+    print(f"converting {args.data[0]} to {args.sav[0]}")
+    if args.data[0].endswith(".jsonl"):
+        articles = gen_jsonl(args.data[0])
+    else:
+        articles = get_json(args.data[0])
+
+    n = to_parquet(articles, args.sav[0])
+    print(f"{n} sentences")
+
+
+def to_parquet(
+    articles: typing.Iterable, path: str, *, batch_size: int = 1000
+) -> int:
+    """Write [url, metadata, ocr] articles to a Parquet corpus at path, return the number of rows.
+
+    Articles are consumed lazily, batch_size articles (a row group) at a time.
+
+    Args:
+        articles (iterable): [url, metadata, {"text": {"s": [...], "neg_log_probability": [...]}}]
+        path (str): e.g., scored.parquet
+        batch_size (int): number of articles per row group
+    """
+    n = 0
+    with pq.ParquetWriter(path, SCHEMA, use_dictionary=DICTIONARY_COLUMNS) as writer:
+        articles = iter(articles)
+        while True:
+            batch = list(itertools.islice(articles, batch_size))
+            if not batch:
+                break
+
+            table = to_table(batch)
+            writer.write_table(table)
+            n += len(table)
+
+    return n
+
+
+def to_table(articles: typing.List) -> pa.Table:
+    """Return a table of a row per sentence of the passed articles."""
+    columns = {name: [] for name in SCHEMA.names}
+
+    for url, metadata, ocr in articles:
+        if not ocr:  # i.e., ocr not retrieved
+            continue
+
+        sentences = ocr["text"]["s"]
+        nlls = ocr["text"]["neg_log_probability"]
+        kb_oai_metadata = metadata["kb_oai_metadata"]
+        metadata_json = json.dumps(metadata, ensure_ascii=False)
+        matching_queries = "\n".join(metadata["matching_queries"])
+
+        for index, (sentence, nll) in enumerate(zip(sentences, nlls)):
+            columns["url"].append(url)
+            columns["sentence_index"].append(index)
+            columns["sentence"].append(sentence)
+            columns["neg_log_probability"].append(nll)
+            columns["spatial_distribution"].append(
+                kb_oai_metadata["spatial_distribution"]
+            )
+            columns["spatial_origin"].append(kb_oai_metadata["spatial_origin"])
+            columns["matching_queries"].append(matching_queries)
+            columns["metadata"].append(metadata_json)
+
+    return pa.Table.from_pydict(columns, schema=SCHEMA)
+
+
+def read_corpus(path: str, *, columns: typing.List = None) -> pa.Table:
+    """Return the (memory-mapped) corpus table, with article-level columns as dictionaries."""
+    return pq.read_table(
+        path,
+        columns=columns,
+        memory_map=True,
+        read_dictionary=[c for c in DICTIONARY_COLUMNS if not columns or c in columns],
+    )
+
+
+def get_articles(
+    path: str,
+    *,
+    queries: typing.Iterable = None,
+    spatial_distributions: typing.Iterable = None,
+) -> typing.List:
+    """Return [url, metadata, {"text": {"s": [...], "neg_log_probability": [...]}}] articles of the corpus.
+
+    I.e., as the articles of scored.json (w/o the full article text), where
+    only those articles are returned which match any of queries and any of
+    spatial_distributions (or all, where None).
+
+    Args:
+        path (str): e.g., scored.parquet
+        queries (iterable): e.g., ['kaukasisch AND date within "1890-01-01 1899-12-31" AND type=artikel', ...]
+        spatial_distributions (iterable): e.g., ['Landelijk', ...]
+    """
+    table = read_corpus(path).unify_dictionaries()
+
+    # ------
+    # filter the sentences by vectorized predicates on the columns
+    # ------
+    mask = np.ones(len(table), dtype=bool)
+
+    if spatial_distributions is not None:
+        value_set = pa.array(list(spatial_distributions), pa.string())
+        mask &= get_mask(
+            table["spatial_distribution"],
+            lambda values: get_bools(pc.is_in(values, value_set=value_set)),
+        )
+
+    if queries is not None:
+        value_set = pa.array(list(queries), pa.string())
+
+        def any_query(values: pa.Array) -> np.ndarray:
+            # i.e., for each "\n" separated value, whether any of its queries match
+            split = pc.split_pattern(values, "\n")
+            matches = get_bools(pc.is_in(pc.list_flatten(split), value_set=value_set))
+            value_mask = np.zeros(len(values), dtype=bool)
+            value_mask[pc.list_parent_indices(split).to_numpy()[matches]] = True
+            return value_mask
+
+        mask &= get_mask(table["matching_queries"], any_query)
+
+    table = table.filter(pa.array(mask))
+
+    # ------
+    # collect the sentences of each (remaining) article, i.e., each run of url
+    # ------
+    url_indices = table["url"].combine_chunks().indices.to_numpy(zero_copy_only=False)
+    starts = np.flatnonzero(np.diff(url_indices, prepend=-1))
+    stops = np.append(starts[1:], len(url_indices))
+
+    # article-level values, once per article
+    urls = table["url"].take(starts).to_pylist()
+    metadata = table["metadata"].take(starts).to_pylist()
+
+    sentences = table["sentence"].to_pylist()
+    nlls = table["neg_log_probability"].to_numpy()
+
+    return [
+        [
+            url,
+            json.loads(article_metadata),
+            {
+                "text": {
+                    "s": sentences[start:stop],
+                    "neg_log_probability": nlls[start:stop].tolist(),
+                }
+            },
+        ]
+        for url, article_metadata, start, stop in zip(urls, metadata, starts, stops)
+    ]
+
+
+def get_mask(column: pa.ChunkedArray, predicate: typing.Callable) -> np.ndarray:
+    """Return a boolean array of predicate over the rows of a dictionary column.
+
+    I.e., predicate is evaluated over the dictionary values only, and mapped
+    to the rows via their dictionary indices.
+
+    Args:
+        column: dictionary encoded column, with a (unified) dictionary shared by its chunks
+        predicate: return a boolean numpy array for an array of values
+    """
+    column = column.combine_chunks()
+    value_mask: np.ndarray = predicate(column.dictionary)
+
+    return value_mask[column.indices.to_numpy(zero_copy_only=False)]
+
+
+def get_bools(array: pa.Array) -> np.ndarray:
+    """Return a boolean numpy array of a boolean arrow array, with nulls as False."""
+    return pc.fill_null(array, False).to_numpy(zero_copy_only=False)
+
+
+def gen_jsonl(filename: str) -> typing.Generator:
+    """Yield the record of each line of a .jsonl file, e.g., [url, metadata, ocr]."""
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_json(filename: str):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    main()
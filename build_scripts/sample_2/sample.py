@@ -15,12 +15,14 @@ import os
 import random
 import re
 import typing
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+import corpus
+
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawTextHelpFormatter,
     description="""Stratified sampling of extracts according to P(extract)
@@ -65,6 +67,12 @@ parser.add_argument(
     required=True,
     type=int,
 )
+parser.add_argument(
+    "-seed",
+    nargs=1,
+    type=int,
+    help="seed of the random sampling, for a reproducible sample",
+)
 parser.add_argument(
     "-sav_dir", nargs=1, help="location to save output sample of extracts", default=""
 )
@@ -72,7 +80,7 @@ parser.add_argument(
 parser.add_argument(
     "-data",
     nargs=1,
-    help="""The relative path to input data.
+    help="""The relative path to input data (.json, .jsonl of an article per line, or .parquet, see corpus.py).
 
     Example structure
     [
@@ -119,25 +127,99 @@ parser.add_argument(
 def main():
 
     args = parser.parse_args()
-    if args.s[0] == "":
+    if not args.sav_dir or args.sav_dir[0] == "":
         sav_dir = ""
     else:
         sav_dir = args.sav_dir[0] + "/"
         os.makedirs(os.path.dirname(sav_dir), exist_ok=True)
 
+    # random number generators, seeded where -seed passed, for a reproducible sample
+    seed = args.seed[0] if args.seed else None
+
+    # ------
+    # get stratified samples of extracts, by query
+    # ------
+    sampled_by_query: typing.Dict = get_sampled_by_query(
+        args.data[0],
+        queries_file=args.q[0],
+        spatial_file=args.s[0],
+        adjacent=args.a[0],
+        n=args.n[0],
+        rng=np.random.default_rng(seed),
+    )
+
+    # -------
+    # further refine samples to meet -N requirement
+    # -------
+
+    print(f"number of query variations = {len(sampled_by_query)}")
+    print(
+        f"number of extracts from which to sample {args.N[0]} = {sum([len(v) for k,v in sampled_by_query.items()])}"
+    )
+
+    # itereate over-randomly shuffled queries, and sample a single w/o replacement until all -N retrieved
+    drawn: typing.List = draw_round_robin(
+        sampled_by_query, args.N[0], rng=random.Random(seed)
+    )
+    if len(drawn) < args.N[0]:
+        print(
+            f"notice: only {len(drawn)} of {args.N[0]} extracts available, shortfall of {args.N[0] - len(drawn)}"
+        )
+
+    print("Saving ...")
+    save_sample(drawn, sav_dir)
+
+
+def get_sampled_by_query(
+    data: str,
+    *,
+    queries_file: str,
+    spatial_file: str,
+    adjacent: int,
+    n: int,
+    rng: np.random.Generator = None,
+) -> typing.Dict:
+    """Return {query: [(url, metadata, extract), ...]} of the stratified samples of extracts in data.
+
+    I.e., load the scored articles of data, find all potential extracts of
+    2 * adjacent + 1 sentences, and, for each (query, spatial distribution)
+    criterion, sample n extracts (randomly, weighted by P(extract)).
+
+    Args:
+        data (str): path to scored articles, .json, .jsonl or .parquet
+        queries_file (str): path to a .txt file of line-separated queries to sample
+        spatial_file (str): path to a .txt file of line-separated spatial distributions to sample
+        adjacent (int): number of sentences before and after the sentence of the target word
+        n (int): number of extracts to sample for every criterion
+        rng (np.random.Generator): [default: np.random.default_rng()]
+    """
+
     # ------
     # get the scored sentences, find potential extracts and append
     # ------
 
     # get the input json of articles information
-    print(f"loading {args.data[0]}")
-    articles: list = get_json(
-        args.data[0]
-    )  # [[ocr_url:str, metadata:dict, ocr:str], ...]
+    print(f"loading {data}")
+    if data.endswith(".parquet"):
+        # read only those articles matching the sampling criteria, see corpus.py
+        articles: list = corpus.get_articles(
+            data,
+            queries=gen_file_lines(queries_file),
+            spatial_distributions=gen_file_lines(spatial_file),
+        )
+    elif data.endswith(".jsonl"):
+        # read article by article, keeping only the (scored) sentences of each text
+        articles: list = [
+            [url, metadata, {"text": get_scored_sentences(ocr["text"])}]
+            for url, metadata, ocr in gen_jsonl(data)
+            if ocr
+        ]
+    else:
+        articles: list = get_json(data)  # [[ocr_url:str, metadata:dict, ocr:str], ...]
 
     # For each article, identify extracts and append to article records (in-place)
-    print(f"collecting all extracts with {args.a[0]} sentences above and below")
-    add_extracts(articles, adjacent=args.a[0])
+    print(f"collecting all extracts with {adjacent} sentences above and below")
+    add_extracts(articles, adjacent=adjacent)
 
     # -------
     # assemble sampling criteria
@@ -145,12 +227,12 @@ def main():
 
     print("Assembling sampling criteria")
     sampling_criteria: typing.Generator = gen_file_lines_combinations(
-        [args.q[0], args.s[0]]
+        [queries_file, spatial_file]
     )  # queries of
 
-    num_samples_per_query = args.n[0]
+    num_samples_per_query = n
     max_extract_chars = (
-        2 * args.a[0] + 1
+        2 * adjacent + 1
     ) * 200  # i.e., max 200 chars per sentence on average
 
     sampling_criteria: typing.Iterator = (
@@ -170,64 +252,39 @@ def main():
     print("Sampling ...")
 
     sampled_extracts: typing.Generator = strat_sample(
-        sampling_criteria, articles
+        sampling_criteria, articles, rng=rng
     )  # sampled_extracts  [(url, metadata, extract, corresponding query), ...]
 
-    # -------
-    # further refine samples to meet -N requirement
-    # -------
-
     sampled_by_query = defaultdict(list)  # {query:[(url, metadata, extract), ...]}
     for extract in sampled_extracts:
         query = extract[3]
         data = extract[:3]  # [url, metadata, extract]
         sampled_by_query[query].append(data)  # {query:[(url, metadata, extract), ...]}
 
-    # get list of randonmnly shuffled query words
-    shuffled_queries = list(sampled_by_query.keys())
-    random.shuffle(
-        shuffled_queries
-    )  # queries randomly shuffled such that none favoured
-
-    print(f"number of query variations = {len(shuffled_queries)}")
-    print(
-        f"number of extracts from which to sample {args.N[0]} = {sum([len(v) for k,v in sampled_by_query.items()])}"
-    )
-
-    # itereate over-randomly shuffled queries, and sample a single w/o replacement until all -N retrieved
-    new_data = {"url": [], "query": [], "extract": [], "metadata": []}
-    index = 0
-    while len(new_data["url"]) < args.N[0]:
-
-        if len(new_data["url"]) % 100 == 0:
-            print(len(new_data["url"]))
-
-        # get the next data point, going in order of shuffled_queries where available
-        while True:
+    return dict(sampled_by_query)
 
-            query = shuffled_queries[index]
 
-            if len(sampled_by_query[query]) > 0:
+def get_new_data(drawn: typing.Iterable) -> typing.Dict:
+    """Return {"url": [...], "query": [...], "extract": [...], "metadata": [...]} of drawn (query, (url, metadata, extract)) pairs."""
 
-                # pop a random extract associated with random query, and then append to new store
-                data = sampled_by_query[query].pop(
-                    random.randint(0, len(sampled_by_query[query]) - 1)
-                )
-                index = index + 1 if index < len(shuffled_queries) - 1 else 0
-                break
-            else:
-                index = index + 1 if index < len(shuffled_queries) - 1 else 0
+    new_data = {"url": [], "query": [], "extract": [], "metadata": []}
+    for query, data in drawn:
 
         # apppend that datapoint
         new_data["url"].append(data[0])
         new_data["extract"].append(data[2])
         new_data["query"].append(query.split(" AND ")[0])
-        data[1]["matching_queries"] = [
-            query
-        ]  # update extract metadata to reflect matched query
-        new_data["metadata"].append(data[1])
+        new_data["metadata"].append(
+            dict(data[1], matching_queries=[query])
+        )  # update extract metadata to reflect matched query
 
-    print("Saving ...")
+    return new_data
+
+
+def save_sample(drawn: typing.Iterable, sav_dir: str) -> typing.NoReturn:
+    """Save drawn (query, (url, metadata, extract)) pairs as sav_dir/sampled.csv and sav_dir/sampled.json."""
+
+    new_data = get_new_data(drawn)
 
     df = pd.DataFrame.from_dict(new_data)
     df.to_csv(sav_dir + "sampled.csv")
@@ -248,6 +305,9 @@ def main():
 def add_extracts(articles: typing.List, *, adjacent: int) -> typing.NoReturn:
     """Get and append (in-place) at 'articles' a list of potential article extracts.
 
+    The sentences of each article are scanned once, for the target words of
+    all its matching queries at once (see TargetMatcher).
+
     Args:
         articles (List): [(url, metadata, text), ...]
         n (int): minimum number of sentences required either side of extract.
@@ -255,30 +315,91 @@ def add_extracts(articles: typing.List, *, adjacent: int) -> typing.NoReturn:
 
     Potential extracts added at:
         articles[url][i]['text']['extracts']
-            = [('query', 'matching n sentence extract', est P(extract)), ...]
+            = [('query', (start, stop) of the n sentence extract, est -log P(extract), chars), ...]
     """
 
+    # a single matcher over the target words of every query
+    matcher = TargetMatcher(
+        set(query for article in articles for query in article[1]["matching_queries"])
+    )
+
     # interate over articles
     for url, metadata, split_sents, split_sents_nlls in get_articles(articles):
 
-        article_extracts = []  # store collected extracts
-
         # identify (and pull) each extract on record ocr that matches a query
-        for query in metadata["matching_queries"]:
+        hits: typing.List = matcher.get_hits(
+            split_sents, metadata["matching_queries"]
+        )
+
+        articles[url][2]["text"]["extracts"] = list(
+            get_blocks(split_sents, split_sents_nlls, hits=hits, adjacent=adjacent)
+        )
+
+
+class TargetMatcher(object):
+    """Find the sentences containing the target words of queries, in a single scan.
+
+    I.e., a single compiled alternation of all target words (case-insensitive,
+    matched literally), where each match of a target word is mapped back to
+    the queries of that target word.
+
+    Args:
+        queries (iterable): e.g., ['allochtoon AND date within "1890-01-01 1899-12-31" AND type=artikel', ...]
+    """
+
+    def __init__(self, queries: typing.Iterable):
+
+        # {target: [queries]}, e.g., {'allochtoon': ['allochtoon AND date within ...', ...]}
+        self.targets = defaultdict(list)
+        for query in queries:
+            self.targets[get_target(query).lower()].append(query)
 
-            # NEED TO REWORK and make regex
-            match_word: str = query.split(" AND ")[0]
+        # a zero-width lookahead, s.t., overlapping matches are all found, and
+        # longest target first, s.t., a target found also finds those it starts with
+        alternatives = sorted(self.targets, key=len, reverse=True)
+        self.pattern = re.compile(
+            "(?=(" + "|".join(re.escape(target) for target in alternatives) + "))",
+            re.IGNORECASE,
+        )
 
-            for extract in get_blocks(
-                split_sents,
-                split_sents_nlls,
-                adjacent=adjacent,
-                query=query,
-                target=match_word,
-            ):
-                article_extracts.append(extract)
+        # {target: [target, and other targets it starts with]}
+        self.prefixes = {
+            target: [other for other in self.targets if target.startswith(other)]
+            for target in self.targets
+        }
 
-        articles[url][2]["text"]["extracts"] = article_extracts
+    def get_hits(
+        self, sentences: typing.List, queries: typing.Iterable
+    ) -> typing.List[typing.Tuple[str, int]]:
+        """Return [(query, sentence index), ...] of the sentences containing the target word of each query.
+
+        Hits are ordered by query (in order of queries), then sentence index.
+
+        Args:
+            sentences (list): e.g., ['de eerste zin', 'the 2nd sentence', ...]
+            queries (iterable): the queries to report, e.g., metadata["matching_queries"]
+        """
+        found = defaultdict(list)  # {target: [sentence index, ...]}
+        for index, sentence in enumerate(sentences):
+            targets = set()
+            for match in self.pattern.finditer(sentence):
+                targets.update(self.prefixes.get(match.group(1).lower(), []))
+            for target in targets:
+                found[target].append(index)
+
+        if not found:
+            return []
+
+        return [
+            (query, index)
+            for query in queries
+            for index in found.get(get_target(query).lower(), [])
+        ]
+
+
+def get_target(query: str) -> str:
+    """Return the target word of a query, e.g., 'allochtoon' for 'allochtoon AND date within ... AND type=artikel'."""
+    return query.split(" AND ")[0]
 
 
 def get_articles(articles: typing.Iterable) -> typing.Generator:
@@ -299,34 +420,52 @@ def get_blocks(
     split_sents: typing.List,
     split_sents_nlls: typing.List,
     *,
-    query: str,
-    target: str,
+    hits: typing.Iterable,
     adjacent: int,
 ) -> typing.Generator:
-    """yield an article's potential extracts in the form (query, extract, est P(extract)).
+    """yield an article's potential extracts in the form (query, (start, stop), est -log P(extract), chars).
+
+    I.e., the extract is the sentences split_sents[start:stop], joined by
+    "\n\n" (see get_extract) only where sampled, of chars characters. The
+    score and characters of each extract are computed from prefix sums of the
+    sentence scores and lengths, i.e., in constant time for any adjacent.
 
     Args:
         split_sents: e.g., ['de eerste zin', 'the 2nd sentence', ...]
-        target: e.g., 'allochtoon'
+        hits: (query, index) of each sentence containing the target word of query, see TargetMatcher
         adjacent: the number of sentences needed above & below the sentence
             containing the target word
     """
+    if not hits:
+        return
+
+    queries, indices = zip(*hits)
+    indices = np.array(indices)
+
+    # we ignore those matches without a preceeding & following sentences
+    valid = (indices >= adjacent) & (indices <= len(split_sents) - 1 - adjacent)
+    starts = indices - adjacent
+    stops = indices + adjacent + 1
+
+    # prefix sums, s.t., the sum over sentences [start:stop] = cum[stop] - cum[start]
+    cum_nlls = np.concatenate(([0.0], np.cumsum(split_sents_nlls)))
+    cum_chars = np.concatenate(([0], np.cumsum([len(sent) for sent in split_sents])))
+
+    # i.e., for valid windows only
+    starts, stops = starts[valid], stops[valid]
+    scores = cum_nlls[stops] - cum_nlls[starts]
+    chars = cum_chars[stops] - cum_chars[starts] + 2 * (stops - starts - 1)
+
+    for query, start, stop, score, n_chars in zip(
+        itertools.compress(queries, valid), starts, stops, scores, chars
+    ):
+        yield (query, (int(start), int(stop)), float(score), int(n_chars))
 
-    for index, sent in enumerate(split_sents):
-        if re.search(target, sent, re.IGNORECASE):
-            # we ignore those matches without a preceeding & following sentences
-            if index < adjacent:
-                pass
-            elif index > len(split_sents) - 1 - adjacent:
-                pass
-            else:
-                yield (
-                    query,
-                    "\n\n".join(split_sents[index - adjacent : index + adjacent + 1]),
-                    sum(
-                        split_sents_nlls[index - adjacent : index + adjacent + 1],
-                    ),
-                )
+
+def get_extract(split_sents: typing.List, window: typing.Tuple[int, int]) -> str:
+    """Return the extract text of a (start, stop) window of sentences, see get_blocks."""
+    start, stop = window
+    return "\n\n".join(split_sents[start:stop])
 
 
 def scale_weights(l: typing.List) -> typing.List:
@@ -335,7 +474,12 @@ def scale_weights(l: typing.List) -> typing.List:
     return (np.array(l) + epsilon) / sum(np.array(l) + epsilon)
 
 
-def strat_sample(criteria: typing.Iterable, articles: typing.List) -> typing.Generator:
+def strat_sample(
+    criteria: typing.Iterable,
+    articles: typing.List,
+    *,
+    rng: np.random.Generator = None,
+) -> typing.Generator:
     """Return a generator of samples [(url, metadata, extract, query), ... ].
 
     where each generated sample fulfilling each criterion in criteria,
@@ -345,56 +489,135 @@ def strat_sample(criteria: typing.Iterable, articles: typing.List) -> typing.Gen
         criteria (iterable): a list of tuples of
             (query, spatial distribution criteria, number of samples, max number of chars in extracts)
         articles (list): list of [url, metadata, text] of articles
+        rng (np.random.Generator): [default: np.random.default_rng()]
     """
+    if rng is None:
+        rng = np.random.default_rng()
 
-    returned = []
+    # the potential extracts of each (query, spatial distribution), in a single pass over articles
+    extract_index: typing.Dict = get_extract_index(articles)
 
     # interate over each sampling criterion
     for c_query, c_spatial, n, max_chars in criteria:
 
+        if (c_query, c_spatial) not in extract_index:
+            continue
+
         # ------
-        # get a list of ALL potential extracts which meet the current criterion
+        # get ALL potential extracts which meet the current criterion
         #   i.e., momentarity ignoring 'n' criteria
         # ------
-        extracts_meeting_criterion: typing.List = []  # [(url, m, extract, score), ...]
-
-        # iterate over articles
-        for url, m, text_info in articles:
-
-            article_spatial: str = m["kb_oai_metadata"]["spatial_distribution"]
-            article_extracts = text_info["text"]["extracts"]
-
-            # interate over extracts in article
-            for extract_q, extract_text, extract_score in article_extracts:
-                if (
-                    extract_q == c_query
-                    and article_spatial == c_spatial
-                    and len(extract_text) <= max_chars
-                ):
-                    extracts_meeting_criterion.append(
-                        (url, m, extract_text, extract_score)
-                    )
+        scores, chars, pointers = extract_index[(c_query, c_spatial)]
+        meeting_criterion: np.ndarray = np.flatnonzero(chars <= max_chars)
 
         # ------
         # from our potential extracts meeting query, spatial_distribution and max_char criteria
         # randomnly sample (w/o replacement) n extracts weighted by P(extract)
         # ------
-        if len(extracts_meeting_criterion) > 0:
-            urls, metadata, extracts, extracts_nlls = zip(*extracts_meeting_criterion)
+        if len(meeting_criterion) > 0:
 
             # sample n extracts, w/o replacement (or fewer if unavailable)
-            sample_indices = np.random.choice(
-                range(len(urls)),
-                size=min(n, len(extracts_meeting_criterion)),
-                p=scale_weights(np.exp(-np.array(extracts_nlls))),
+            sample_indices = rng.choice(
+                range(len(meeting_criterion)),
+                size=min(n, len(meeting_criterion)),
+                p=scale_weights(np.exp(-scores[meeting_criterion])),
                 replace=False,
             )
 
-            # successively yield
-            for index in sample_indices:
-                yield (urls[index], metadata[index], extracts[index], c_query)
+            # successively yield, joining the text of sampled extracts only
+            for index in meeting_criterion[sample_indices]:
+                article_index, window = pointers[index]
+                url, m, text_info = articles[article_index]
+                extract = get_extract(text_info["text"]["s"], window)
+                yield (url, m, extract, c_query)
+
+
+def draw_round_robin(
+    buckets: typing.Dict,
+    n: int,
+    *,
+    rng: random.Random,
+    seen: typing.Set = None,
+    key: typing.Callable = None,
+) -> typing.List[typing.Tuple]:
+    """Return [(key, item), ...] of n items drawn w/o replacement, a bucket at a time, in turn.
+
+    I.e., the buckets (e.g., {query: [(url, metadata, extract), ...]}) are
+    visited in a random order, repeatedly, and a random item is drawn from
+    each visited bucket, where buckets are dropped once empty. Where fewer
+    than n items exist, all items are returned.
+
+    Where seen is passed, items whose key(item) is in seen are skipped, and
+    the keys of drawn items added to seen, e.g., to draw several samples
+    without duplicates between them.
+
+    Args:
+        buckets (dict): {key: [items]}, not modified
+        n (int): number of items to draw
+        rng (random.Random):
+        seen (set): keys of items (already drawn) not to be drawn
+        key (callable): return the key of an item [default: the item]
+    """
+    # shuffle the keys (s.t., none favoured) and the items of each bucket once,
+    # s.t., taking the last item of a bucket is a random draw
+    keys = list(buckets)
+    rng.shuffle(keys)
+
+    queue = deque()  # (bucket key, items) of non-empty buckets, in turn
+    for bucket in keys:
+        items = list(buckets[bucket])
+        if items:
+            rng.shuffle(items)
+            queue.append((bucket, items))
+
+    drawn = []
+    while queue and len(drawn) < n:
+        bucket, items = queue.popleft()
+        item = items.pop()
+
+        if seen is not None:
+            # skip (and, as such, discard) items already drawn
+            item_key = key(item) if key else item
+            if item_key in seen:
+                if items:
+                    queue.appendleft((bucket, items))
+                continue
+            seen.add(item_key)
+
+        drawn.append((bucket, item))
+        if items:
+            queue.append((bucket, items))
+
+    return drawn
+
+
+def get_extract_index(articles: typing.List) -> typing.Dict:
+    """Return {(query, spatial distribution): (scores, chars, pointers)} of the extracts of articles.
+
+    I.e., for each (query, spatial distribution), the arrays of est -log P(extract)
+    and number of characters of its potential extracts, and a pointer to each,
+    (article index, (start, stop) window), in order of articles.
+
+    Args:
+        articles (list): list of [url, metadata, text] of articles, with extracts (see add_extracts)
+    """
+    columns = defaultdict(lambda: ([], [], []))  # {key: (scores, chars, pointers)}
+
+    for article_index, (url, m, text_info) in enumerate(articles):
+        article_spatial: str = m["kb_oai_metadata"]["spatial_distribution"]
+
+        for extract_q, extract_window, extract_score, extract_chars in text_info[
+            "text"
+        ]["extracts"]:
+            scores, chars, pointers = columns[(extract_q, article_spatial)]
+            scores.append(extract_score)
+            chars.append(extract_chars)
+            pointers.append((article_index, extract_window))
 
-    return returned
+    return {
+        key: (np.array(scores, dtype=float), np.array(chars, dtype=int), pointers)
+        for key, (scores, chars, pointers) in columns.items()
+    }
 
 
 def get_json(filename: str):
@@ -402,6 +625,19 @@ def get_json(filename: str):
         return json.load(f)
 
 
+def gen_jsonl(filename: str) -> typing.Generator:
+    """Yield the record of each line of a .jsonl file, e.g., [url, metadata, ocr]."""
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_scored_sentences(text: typing.Dict) -> typing.Dict:
+    """Return the "s" and "neg_log_probability" entries of an article text, as needed for add_extracts."""
+    return {"s": text["s"], "neg_log_probability": text["neg_log_probability"]}
+
+
 def to_json(container, filename: str) -> typing.NoReturn:
     with open(filename, "w") as f:
         json.dump(container, f, indent=4, ensure_ascii=False)